@@ -7,34 +7,141 @@
 import openslide
 from PIL import Image
 import os
+import json
 import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+def save_label_image(slide, output_label_path, rotate):
+    if 'label' in slide.associated_images:
+        # Get the label image as a PIL Image object
+        label_image = slide.associated_images['label']
+        if rotate:
+            label_image = label_image.rotate(180)
+        file_ext = os.path.splitext(output_label_path)[1].lower()
+        if file_ext in ('.jpg', '.jpeg'):
+            label_image = label_image.convert("RGB")
+            label_image.save(output_label_path, format="JPEG")
+        elif file_ext in ('tif', 'tiff'):
+            label_image.save(output_label_path, format="TIFF")
+        else:
+            raise ValueError("Output file extention is not supported.")
+    else:
+        raise ValueError("No 'label' image found in the MRXS file's associated images.")
+
+def get_slide_files_stat(mrxs_file_path):
+    """
+    Size and modification time of a slide: the MRXS file plus its data folder (same name without extension),
+    so a slide is rescanned if any of its files changes.
+    """
+    stat = os.stat(mrxs_file_path)
+    size, mtime = stat.st_size, stat.st_mtime
+    data_folder = os.path.splitext(mrxs_file_path)[0]
+    if os.path.isdir(data_folder):
+        for entry in os.scandir(data_folder):
+            if entry.is_file():
+                size += entry.stat().st_size
+                mtime = max(mtime, entry.stat().st_mtime)
+    return {'size': size, 'mtime': mtime}
+
+def get_property(slide, name, type_func=float):
+    value = slide.properties.get(name)
+    return type_func(value) if value is not None else None
+
+def scan_slide(mrxs_file_path, outdir, rotate, thumbnail_size):
+    """
+    Open a slide once and extract its catalog entry: dimensions, levels, MPP, bounds,
+    the label image ({outdir}/{name}.label.jpg) and a thumbnail ({outdir}/{name}.thumbnail.jpg).
+    Errors are recorded in the entry instead of raised, so one bad slide does not stop a scan.
+    """
+    name = os.path.splitext(os.path.basename(mrxs_file_path))[0]
+    entry = {'name': name, 'error': None}
+    try:
+        with openslide.OpenSlide(mrxs_file_path) as slide:
+            entry['dimensions'] = slide.dimensions
+            entry['level_count'] = slide.level_count
+            entry['level_dimensions'] = slide.level_dimensions
+            entry['level_downsamples'] = slide.level_downsamples
+            entry['mpp_x'] = get_property(slide, openslide.PROPERTY_NAME_MPP_X)
+            entry['mpp_y'] = get_property(slide, openslide.PROPERTY_NAME_MPP_Y)
+            entry['objective_power'] = get_property(slide, openslide.PROPERTY_NAME_OBJECTIVE_POWER)
+            entry['bounds'] = [get_property(slide, prop, int) for prop in (openslide.PROPERTY_NAME_BOUNDS_X, openslide.PROPERTY_NAME_BOUNDS_Y,
+                                                                           openslide.PROPERTY_NAME_BOUNDS_WIDTH, openslide.PROPERTY_NAME_BOUNDS_HEIGHT)]
+            entry['label_image'] = None
+            if 'label' in slide.associated_images:
+                entry['label_image'] = os.path.join(outdir, f"{name}.label.jpg")
+                save_label_image(slide, entry['label_image'], rotate)
+            entry['thumbnail'] = None
+            if thumbnail_size > 0:
+                entry['thumbnail'] = os.path.join(outdir, f"{name}.thumbnail.jpg")
+                slide.get_thumbnail((thumbnail_size, thumbnail_size)).convert("RGB").save(entry['thumbnail'], format="JPEG")
+    except (openslide.OpenSlideError, OSError, ValueError) as e:
+        entry['error'] = f"{type(e).__name__}: {e}"
+    return entry
+
+def is_catalog_entry_current(entry, files_stat, scan_options):
+    """ A catalog entry is reused if the slide files and scan options are unchanged and its outputs still exist """
+    if entry is None or entry.get('error') or entry.get('files') != files_stat or entry.get('options') != scan_options:
+        return False
+    return all(os.path.exists(entry[k]) for k in ('label_image', 'thumbnail') if entry.get(k))
+
+def save_catalog(catalog, catalog_file):
+    tmp_file = f"{catalog_file}.tmp"
+    with open(tmp_file, 'w', encoding="utf-8") as fout:
+        json.dump(catalog, fout, indent=2)
+    os.replace(tmp_file, catalog_file)
+
+def scan(args):
+    """
+    Scan every *.mrxs of a folder across a process pool, opening each slide once.
+    Results are kept in a JSON catalog keyed by the absolute slide path, with the size / mtime of the
+    slide files; re-runs only scan new or changed slides (and slides that failed before).
+    Prints "name<TAB>width,height" per slide in name order, as parse_mrxs_files.sh did.
+    """
+    os.makedirs(args.outdir, exist_ok=True)
+    catalog_file = args.catalog or f"{os.path.basename(os.path.abspath(args.mrxs_file_path))}.mrxs_catalog.json"
+    catalog = json.load(open(catalog_file, 'r', encoding="utf-8")) if os.path.exists(catalog_file) else {}
+    scan_options = {'outdir': os.path.abspath(args.outdir), 'rotate': args.rotate, 'thumbnail_size': args.thumbnail_size}
+
+    mrxs_files = sorted(str(path.resolve()) for path in Path(args.mrxs_file_path).glob("*.mrxs"))
+    dict_files_stat = {mrxs: get_slide_files_stat(mrxs) for mrxs in mrxs_files}
+    mrxs_to_scan = [mrxs for mrxs in mrxs_files if not is_catalog_entry_current(catalog.get(mrxs), dict_files_stat[mrxs], scan_options)]
+    print(f"Scan {len(mrxs_to_scan)} of {len(mrxs_files)} slides ({len(mrxs_files) - len(mrxs_to_scan)} unchanged in {catalog_file})", file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(scan_slide, mrxs, scan_options['outdir'], args.rotate, args.thumbnail_size): mrxs for mrxs in mrxs_to_scan}
+        for future in as_completed(futures):
+            mrxs = futures[future]
+            entry = future.result()
+            entry['files'] = dict_files_stat[mrxs]
+            entry['options'] = scan_options
+            catalog[mrxs] = entry
+            if entry['error']:
+                print(f"ERROR: {mrxs}: {entry['error']}", file=sys.stderr)
+            save_catalog(catalog, catalog_file) # Keep the progress of an interrupted scan
+
+    for mrxs in mrxs_files:
+        entry = catalog[mrxs]
+        if not entry['error']:
+            size_x, size_y = entry['dimensions']
+            print(f"{entry['name']}\t{size_x},{size_y}")
 
 def main(args):
+    if args.command == "scan":
+        scan(args)
+        return
     with openslide.OpenSlide(args.mrxs_file_path) as slide:
         if args.command == "size":
             size_x, size_y = slide.dimensions
             print(f"{size_x},{size_y}")
         elif args.command == "label_image":
-            if 'label' in slide.associated_images:
-                # Get the label image as a PIL Image object
-                label_image = slide.associated_images['label']
-                if args.rotate:
-                    label_image = label_image.rotate(180)
-                file_ext = os.path.splitext(args.output_label_path)[1].lower()
-                if file_ext in ('.jpg', '.jpeg'):
-                    label_image = label_image.convert("RGB")
-                    label_image.save(args.output_label_path, format="JPEG")
-                elif file_ext in ('tif', 'tiff'):
-                    label_image.save(args.output_label_path, format="TIFF")
-                else:
-                    raise ValueError("Output file extention is not supported.")
-            else:
-                raise ValueError("No 'label' image found in the MRXS file's associated images.")
+            save_label_image(slide, args.output_label_path, args.rotate)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     # Common arguments
-    parser.add_argument("mrxs_file_path")
+    parser.add_argument("mrxs_file_path", help="MRXS file, or folder of MRXS files for scan")
     subparser = parser.add_subparsers(dest="command", required=True)
     # Get slide size
     parser_size = subparser.add_parser("size", help="Get slide dimensions")
@@ -42,6 +149,12 @@ if __name__ == "__main__":
     parser_label = subparser.add_parser("label_image", help="Save label image")
     parser_label.add_argument("output_label_path")
     parser_label.add_argument("--rotate", action='store_true')
+    # Scan a folder of slides
+    parser_scan = subparser.add_parser("scan", help="Open every MRXS of a folder once: dimensions, levels, MPP, bounds, label image and thumbnail into a catalog")
+    parser_scan.add_argument("--catalog", help="Catalog JSON, reused across runs (default: <folder name>.mrxs_catalog.json)")
+    parser_scan.add_argument("--outdir", default=".", help="Folder of the label images and thumbnails (default: .)")
+    parser_scan.add_argument("--rotate", action='store_true', help="Rotate the label image by 180 degrees")
+    parser_scan.add_argument("--thumbnail_size", type=int, default=1024, help="Max thumbnail width / height, 0 for no thumbnail (default: 1024)")
+    parser_scan.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of slides scanned in parallel (default: number of CPUs)")
     arguments = parser.parse_args()
     main(arguments)
-
@@ -9,14 +9,10 @@ dir_mrxs=$1
 rotate=$2
 bin=$(dirname $0)
 
-for x in ${dir_mrxs}/*.mrxs; do 
-    b=$(basename $x .mrxs)
-    echo -ne "${b}\t"
-    /home/olivia/anaconda3/envs/openslide/bin/python ${bin}/parse_mrxs.py $x size
-    if [ ${rotate} -eq 1 ];then 
-        /home/olivia/anaconda3/envs/openslide/bin/python ${bin}/parse_mrxs.py $x label_image ${b}.label.jpg --rotate
-    else
-        /home/olivia/anaconda3/envs/openslide/bin/python ${bin}/parse_mrxs.py $x label_image ${b}.label.jpg
-    fi
-done > $(basename $PWD).mrxs.log
-
+# One pass over the slides: each slide is opened once for its size, label image and thumbnail,
+# in parallel; slides unchanged since the last run are read from the catalog.
+rotate_option=""
+if [ ${rotate} -eq 1 ];then 
+    rotate_option="--rotate"
+fi
+/home/olivia/anaconda3/envs/openslide/bin/python ${bin}/parse_mrxs.py ${dir_mrxs} scan --outdir . --catalog $(basename $PWD).mrxs_catalog.json ${rotate_option} > $(basename $PWD).mrxs.log
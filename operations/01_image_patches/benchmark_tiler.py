@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import argparse
+import itertools
+import math
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from datetime import datetime
+import numpy as np
+import openslide
+import tifffile
+
+
+# In[ ]:
+
+
+TILER = Path(__file__).resolve().parent / "mrxs_to_image_patches.py"
+TIFF_TILE_SIZE = 256
+OUTPUT_IMAGE_FORMATS = ['JPEG', 'JPEG-low', 'PNG', 'TIFF']
+BACKGROUND_COLORS = {'white': 240, 'black': 0} # glass / unscanned area of an MRXS
+REPORT_COLUMNS = ['commit', 'slide', 'width', 'height', 'tissue_fraction', 'background',
+                  'patch_size', 'image_format', 'workers', 'repeat', 'status', 'wall_sec',
+                  'num_patches', 'num_written', 'patches_per_sec', 'mb_written', 'mb_per_sec', 'peak_rss_mb']
+REPORT_KEY = ['slide', 'patch_size', 'image_format', 'workers']
+
+def parse_list(value, item_type=str):
+    """ argparse type for comma-separated lists """
+    return [item_type(item) for item in value.split(",") if item]
+
+def parse_slide_size(value):
+    """ 'WIDTHxHEIGHT' -> (width, height) """
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+def get_git_commit():
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=TILER.parent, capture_output=True, text=True, check=False)
+    return result.stdout.strip() or "unknown"
+
+def iter_synthetic_tiles(width, height, downsample, tissue_fraction, background, seed):
+    """
+    Yield the TIFF tiles (row-major) of one pyramid level of a synthetic slide.
+    Tissue is an ellipse centered on the slide covering tissue_fraction of its area, filled with
+    H&E-like colour noise; the rest is background. Each level is generated at its own scale.
+    """
+    level_width, level_height = math.ceil(width / downsample), math.ceil(height / downsample)
+    scale = math.sqrt(4 * tissue_fraction / math.pi) # ellipse axes relative to the slide half-size
+    rng = np.random.default_rng(seed)
+    for y in range(0, level_height, TIFF_TILE_SIZE):
+        for x in range(0, level_width, TIFF_TILE_SIZE):
+            yy, xx = np.mgrid[y:y + TIFF_TILE_SIZE, x:x + TIFF_TILE_SIZE] * downsample
+            is_tissue = ((yy - height / 2) / (height / 2 * scale)) ** 2 + ((xx - width / 2) / (width / 2 * scale)) ** 2 < 1
+            tile = np.full((TIFF_TILE_SIZE, TIFF_TILE_SIZE, 3), BACKGROUND_COLORS[background], np.uint8)
+            if background == 'white':
+                tile += rng.integers(0, 8, tile.shape, dtype=np.uint8)
+            if is_tissue.any():
+                noise = rng.integers(-40, 40, (int(is_tissue.sum()), 3))
+                tile[is_tissue] = np.clip(np.array([200, 120, 170]) + noise, 0, 255)
+            yield tile
+
+def create_synthetic_slide(slide_file, width, height, tissue_fraction, background, compression):
+    """ Write a tiled pyramidal TIFF (levels down to < 2 TIFF tiles wide) readable by OpenSlide """
+    with tifffile.TiffWriter(slide_file, bigtiff=True) as tiff:
+        for level in itertools.count():
+            downsample = 2 ** level
+            level_shape = (math.ceil(height / downsample), math.ceil(width / downsample), 3)
+            tiff.write(iter_synthetic_tiles(width, height, downsample, tissue_fraction, background, seed=level),
+                       shape=level_shape, dtype=np.uint8, tile=(TIFF_TILE_SIZE, TIFF_TILE_SIZE),
+                       photometric='rgb', compression=compression, metadata=None, subfiletype=(1 if level else 0),
+                       resolution=(40000, 40000), resolutionunit='CENTIMETER')
+            if min(level_shape[:2]) < 2 * TIFF_TILE_SIZE:
+                break
+
+def get_slide(args, width, height):
+    """ Create the synthetic slide once in {workdir}/slides and check that OpenSlide can open it """
+    slide_folder = Path(args.workdir) / "slides"
+    slide_folder.mkdir(parents=True, exist_ok=True)
+    slide_file = slide_folder / f"synthetic_{width}x{height}.tissue{args.tissue_fraction}.{args.background}.{args.compression}.tiff"
+    if not slide_file.exists():
+        print(f"Create {slide_file}")
+        create_synthetic_slide(f"{slide_file}.tmp", width, height, args.tissue_fraction, args.background, args.compression)
+        os.rename(f"{slide_file}.tmp", slide_file)
+    with openslide.OpenSlide(str(slide_file)) as slide:
+        if slide.dimensions != (width, height) or slide.level_count < 2:
+            raise ValueError(f"OpenSlide reads {slide_file} as {slide.dimensions} with {slide.level_count} levels")
+    return slide_file
+
+def get_folder_size(folder):
+    """ Bytes of all files under folder, excluding the checkpoint """
+    num_bytes = 0
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        num_bytes += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return num_bytes
+
+def run_tiler(args, slide_file, patch_size, image_format, workers):
+    """
+    Run the tiler on one slide in a fresh process and return the measurements.
+    Peak RSS is the largest resident set of the tiler or any of its worker processes.
+    """
+    run_folder = Path(args.workdir) / "runs" / f"{slide_file.stem}.{patch_size}.{image_format}.w{workers}"
+    if run_folder.exists():
+        shutil.rmtree(run_folder)
+    run_folder.mkdir(parents=True)
+    cmd = [sys.executable, str(TILER), "--mrxs", str(slide_file.resolve()), "--op", "bench",
+           "--patch_size", str(patch_size), "--output_image_format", image_format,
+           "--outdir", ".", "--workers", str(workers)] + args.tiler_args.split()
+
+    time_start = time.perf_counter()
+    with open(run_folder / "tiler.stdout.txt", 'w', encoding="utf-8") as fout:
+        proc = subprocess.Popen(cmd, cwd=run_folder, stdout=fout, stderr=subprocess.STDOUT)
+        _, wait_status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(wait_status)
+    wall_sec = time.perf_counter() - time_start
+
+    result = {'status': 'ok' if proc.returncode == 0 else f"exit_{proc.returncode}",
+              'wall_sec': wall_sec, 'peak_rss_mb': rusage.ru_maxrss / 1024}
+    log_entries = {}
+    for log_file in run_folder.glob("bench.image_patches.*.log"):
+        with open(log_file, 'r', encoding="utf-8") as fin:
+            for line in fin:
+                if line.startswith("[Patch information]"):
+                    break
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 2:
+                    log_entries[fields[0]] = fields[1]
+    num_patches = int(log_entries.get('num_patches', 0))
+    num_written = num_patches - int(log_entries.get('num_black_patch', 0)) - int(log_entries.get('num_background_patch', 0))
+    num_bytes = sum(get_folder_size(folder) for folder in run_folder.iterdir() if folder.is_dir())
+    result.update({
+        'num_patches': num_patches,
+        'num_written': num_written,
+        'patches_per_sec': num_written / wall_sec,
+        'mb_written': num_bytes / 1024 ** 2,
+        'mb_per_sec': num_bytes / 1024 ** 2 / wall_sec,
+    })
+    if not args.keep_output:
+        shutil.rmtree(run_folder)
+    return result
+
+def read_report(report_file):
+    """ Report rows as dicts keyed by REPORT_COLUMNS """
+    with open(report_file, 'r', encoding="utf-8") as fin:
+        columns = fin.readline().rstrip("\n").split("\t")
+        return [dict(zip(columns, line.rstrip("\n").split("\t"))) for line in fin if line.strip()]
+
+def get_mean_throughput(rows):
+    """ (slide, patch_size, image_format, workers) -> mean patches/sec of the successful repeats """
+    dict_values = {}
+    for row in rows:
+        if row['status'] == 'ok':
+            dict_values.setdefault(tuple(row[k] for k in REPORT_KEY), []).append(float(row['patches_per_sec']))
+    return {k: sum(v) / len(v) for (k, v) in dict_values.items()}
+
+def compare_reports(baseline_file, report_file):
+    """ Print the throughput of report_file relative to baseline_file for the configurations in both """
+    baseline, current = get_mean_throughput(read_report(baseline_file)), get_mean_throughput(read_report(report_file))
+    print("\t".join(REPORT_KEY + ['baseline_patches_per_sec', 'patches_per_sec', 'ratio']))
+    for key in sorted(set(baseline) & set(current)):
+        print("\t".join(key) + f"\t{baseline[key]:.1f}\t{current[key]:.1f}\t{current[key] / baseline[key]:.3f}")
+
+def main(args):
+    if args.compare and args.report_only:
+        compare_reports(args.compare, args.report_only)
+        return
+    if not 0 < args.tissue_fraction <= math.pi / 4:
+        sys.exit(f"ERROR: --tissue_fraction must be in (0, {math.pi / 4:.3f}], the tissue ellipse has to fit in the slide (got {args.tissue_fraction})!")
+    unsupported = set(args.formats) - set(OUTPUT_IMAGE_FORMATS)
+    if unsupported:
+        sys.exit(f"ERROR: Unsupported output image format {sorted(unsupported)}, choose from {OUTPUT_IMAGE_FORMATS}!")
+
+    Path(args.workdir).mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_file = args.report or f"benchmark_tiler.{timestamp}.tsv"
+    commit = get_git_commit()
+
+    with open(report_file, 'w', encoding="utf-8") as fout:
+        fout.write("\t".join(REPORT_COLUMNS) + "\n")
+        for (width, height) in args.slide_sizes:
+            slide_file = get_slide(args, width, height)
+            for (patch_size, image_format, workers, repeat) in itertools.product(args.patch_sizes, args.formats, args.workers, range(args.repeat)):
+                result = run_tiler(args, slide_file, patch_size, image_format, workers)
+                row = {'commit': commit, 'slide': slide_file.name, 'width': width, 'height': height,
+                       'tissue_fraction': args.tissue_fraction, 'background': args.background,
+                       'patch_size': patch_size, 'image_format': image_format, 'workers': workers, 'repeat': repeat}
+                row.update(result)
+                fout.write("\t".join(f"{row[k]:.3f}" if isinstance(row[k], float) else str(row[k]) for k in REPORT_COLUMNS) + "\n")
+                fout.flush()
+                print(f"{slide_file.name}\tpatch_size={patch_size}\t{image_format}\tworkers={workers}\t#{repeat}\t{row['status']}\t"
+                      f"{row['patches_per_sec']:.1f} patches/s\t{row['mb_per_sec']:.1f} MB/s\tpeak RSS {row['peak_rss_mb']:.0f} MB")
+    print(f"Report: {report_file}")
+    if args.compare:
+        compare_reports(args.compare, report_file)
+
+if __name__ == "__main__":
+    # ~/anaconda3/envs/openslide/bin/python
+    parser = argparse.ArgumentParser(description="Benchmark mrxs_to_image_patches.py on synthetic pyramidal TIFF slides")
+    parser.add_argument("--workdir", default="benchmark_tiler", help="Synthetic slides are cached in <workdir>/slides, tiler runs go to <workdir>/runs (default: benchmark_tiler)")
+    parser.add_argument("--slide_sizes", type=lambda v: parse_list(v, parse_slide_size), default=[(20480, 15360)], help="Comma-separated level 0 sizes WIDTHxHEIGHT (default: 20480x15360)")
+    parser.add_argument("--tissue_fraction", type=float, default=0.3, help="Fraction of the slide area covered by tissue (default: 0.3)")
+    parser.add_argument("--background", default="white", choices=list(BACKGROUND_COLORS), help="white: glass, black: unscanned area (default: white)")
+    parser.add_argument("--compression", default="zlib", help="TIFF tile compression of the synthetic slide, e.g. zlib, none, jpeg (needs imagecodecs) (default: zlib)")
+    parser.add_argument("--patch_sizes", type=lambda v: parse_list(v, int), default=[1024], help="Comma-separated patch sizes (default: 1024)")
+    parser.add_argument("--formats", type=parse_list, default=OUTPUT_IMAGE_FORMATS, help=f"Comma-separated output image formats (default: {','.join(OUTPUT_IMAGE_FORMATS)})")
+    parser.add_argument("--workers", type=lambda v: parse_list(v, int), default=[1], help="Comma-separated worker counts (default: 1)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per configuration (default: 1)")
+    parser.add_argument("--tiler_args", default="", help="Extra arguments passed to the tiler, e.g. '--min_tissue_fraction 0.05'")
+    parser.add_argument("--keep_output", action="store_true", help="Keep the tiler output of each run")
+    parser.add_argument("--report", help="Report TSV file, one row per run (default: benchmark_tiler.<timestamp>.tsv)")
+    parser.add_argument("--compare", help="Baseline report TSV: print the throughput ratio per configuration after the run")
+    parser.add_argument("--report_only", help="With --compare: compare this existing report instead of running the benchmark")
+    arguments = parser.parse_args()
+    main(arguments)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import argparse
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from patch_store import OUTPUT_BACKENDS, open_patch_store_reader
+
+
+# In[ ]:
+
+
+def parse_row_col(image_name):
+    """
+    Parse row and column index from a patch name
+    Naming pattern: patch.row_col.yoffset_xoffset.ext
+    """
+    match = re.search(r'(\S+)\.(\d+)_(\d+)\.(\d+)_(\d+)', os.path.splitext(image_name)[0])
+    if match:
+        return int(match.group(2)), int(match.group(3))
+    return None
+
+def select_patches(image_names, args):
+    """ Select patches by name list and / or inclusive row / column range """
+    selected = image_names
+    if args.patch_list:
+        with open(args.patch_list, 'r', encoding="utf-8") as fin:
+            wanted = {os.path.basename(line.strip()) for line in fin if line.strip()}
+        missing = wanted - set(image_names)
+        if missing:
+            print(f"WARNING: {len(missing)} patches in {args.patch_list} are not in the store, e.g. {sorted(missing)[0]}")
+        selected = [name for name in selected if name in wanted]
+    if args.rows or args.cols:
+        row_start, row_end = args.rows or (0, sys.maxsize)
+        col_start, col_end = args.cols or (0, sys.maxsize)
+        lst_selected = []
+        for name in selected:
+            row_col = parse_row_col(name)
+            if row_col and (row_start <= row_col[0] <= row_end) and (col_start <= row_col[1] <= col_end):
+                lst_selected.append(name)
+        selected = lst_selected
+    return selected
+
+def main(args):
+    if not Path(args.store_folder).is_dir():
+        sys.exit(f"ERROR: Store folder [{args.store_folder}] does not exist!")
+    if not (args.patch_list or args.rows or args.cols):
+        sys.exit("ERROR: Select patches with --patch_list and / or --rows / --cols!")
+
+    # Materialize the patches under {outdir}/{store folder name}, as the files backend would have written them
+    output_folder = Path(args.outdir) / Path(args.store_folder).name
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    reader = open_patch_store_reader(args.backend, args.store_folder)
+    selected = select_patches(reader.get_image_names(), args)
+
+    def extract(name):
+        """ Write one patch; return 'written', 'skipped' (already materialized) or 'failed' """
+        data = reader.read(name)
+        if data is None:
+            print(f"ERROR: Cannot read {name} from {args.store_folder}")
+            return 'failed'
+        output_file = output_folder / name
+        if output_file.exists() and output_file.stat().st_size == len(data):
+            return 'skipped'
+        with open(output_file, 'wb') as fout:
+            fout.write(data)
+        return 'written'
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        lst_status = list(executor.map(extract, selected))
+    reader.close()
+
+    print(f"Selected {len(selected)} patches -> {output_folder}: "
+          f"{lst_status.count('written')} written, {lst_status.count('skipped')} already present, {lst_status.count('failed')} failed.")
+    if 'failed' in lst_status:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    # ~/anaconda3/envs/openslide/bin/python
+    parser = argparse.ArgumentParser(description="Materialize selected patches from a patch store (e.g. mrxs_to_image_patches.py --output_backend tar) into a folder such as the CVAT share")
+    parser.add_argument("--store_folder", required=True, help="Folder holding the tar shards and index files, e.g. <outdir>/<op>")
+    parser.add_argument("--outdir", required=True, help="Patches are written to <outdir>/<store folder name>/")
+    parser.add_argument("--backend", default="tar", choices=OUTPUT_BACKENDS)
+    parser.add_argument("--patch_list", help="File with one patch name per line (basename or path)")
+    parser.add_argument("--rows", type=int, nargs=2, metavar=("ROW_START", "ROW_END"), help="Inclusive row range")
+    parser.add_argument("--cols", type=int, nargs=2, metavar=("COL_START", "COL_END"), help="Inclusive column range")
+    parser.add_argument("--threads", type=int, default=8)
+    arguments = parser.parse_args()
+    main(arguments)
@@ -5,18 +5,37 @@
 
 
 import argparse
+import io
+import json
 import os
+import queue
+import shutil
 import sys
 import math
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
 from datetime import datetime
+import numpy as np
 import openslide
 from PIL import Image
+from patch_encoder import JPEG_ENCODERS, get_encoder
+from patch_manifest import MANIFEST_COLUMNS, format_manifest_line, parse_manifest_line, read_manifest
+from patch_store import OUTPUT_BACKENDS, open_patch_store, open_patch_store_reader
 
 
 # In[ ]:
 
 
+LEVEL_HIGHEST_RES = 0
+CHECKPOINT_FOLDER = ".checkpoint" # under the output folder while the slide is tiled, one append-only file per tiling process; removed once it is done
+# Stages timed per patch with --timings, in pipeline order (read is timed per read_region call, see
+# read_blocks). queue_wait is the time the reader waits for a free pipeline slot, i.e. read is ahead
+# of encode / write.
+TIMING_STAGES = ['read', 'queue_wait', 'pad', 'downsample', 'convert', 'encode', 'write']
+
 def get_reduction_factor(level):
     """"
     level 0: 1024 px, reduction factor=0
@@ -45,141 +64,975 @@ def get_image_file_extension(file_format):
         return "png"
     return None
 
-def main(args):
-    #------------------------------------------
-    # Check inputs and create output directory
-    #------------------------------------------
-    # Check if input MRXS exists
-    if not Path(args.mrxs).exists():
-        sys.exit(f"ERROR: Input MRSX file [{args.mrxs}] does not exist!")
+def parse_levels(levels):
+    """ Parse comma-separated output levels (e.g. '0,1,2') into a sorted list of unique levels """
+    lst_level = sorted({int(level) for level in levels.split(",")})
+    if lst_level[0] < 0:
+        raise ValueError(f"Negative level in {levels}")
+    return lst_level
+
+def get_roi(slide, roi):
+    """
+    Region of interest (x, y, width, height) in level 0 coordinates, clipped to the slide:
+    - 'full':   the whole level 0 canvas
+    - 'bounds': the scanned area from the openslide.bounds-* properties (MRXS), or the whole canvas if absent
+    - 'x,y,width,height' in level 0 pixels
+    - a JSON file with keys x, y, width, height in level 0 pixels
+    """
+    if roi == 'full':
+        x, y, width, height = (0, 0, *slide.dimensions)
+    elif roi == 'bounds':
+        props = slide.properties
+        if openslide.PROPERTY_NAME_BOUNDS_X in props:
+            x = int(props[openslide.PROPERTY_NAME_BOUNDS_X])
+            y = int(props[openslide.PROPERTY_NAME_BOUNDS_Y])
+            width = int(props[openslide.PROPERTY_NAME_BOUNDS_WIDTH])
+            height = int(props[openslide.PROPERTY_NAME_BOUNDS_HEIGHT])
+        else:
+            x, y, width, height = (0, 0, *slide.dimensions)
+    elif roi.lower().endswith(".json"):
+        roi_json = json.load(open(roi, 'r', encoding="utf-8"))
+        x, y, width, height = (int(roi_json[k]) for k in ('x', 'y', 'width', 'height'))
+    else:
+        try:
+            x, y, width, height = (int(v) for v in roi.split(","))
+        except ValueError as e:
+            raise ValueError(f"ROI must be 'full', 'bounds', 'x,y,width,height' or a JSON file (got {roi})") from e
+
+    # Clip to the slide
+    x_end = min(x + width, slide.dimensions[0])
+    y_end = min(y + height, slide.dimensions[1])
+    x, y = max(x, 0), max(y, 0)
+    if x_end <= x or y_end <= y:
+        raise ValueError(f"ROI {roi} does not overlap the slide {slide.dimensions}")
+    return x, y, x_end - x, y_end - y
 
+def get_patch_size(args, grid, y, x):
+    """ Valid (patch_size_y, patch_size_x) of the patch at level 0 offset (y, x); smaller than patch_size at the slide edge """
+    patch_size_x = min(args.patch_size, grid['slide_dimensions'][0] - x)
+    patch_size_y = min(args.patch_size, grid['slide_dimensions'][1] - y)
+    return patch_size_y, patch_size_x
+
+def get_saturation(rgba):
+    """ HSV saturation (0-255) of an RGBA uint8 array """
+    rgb = rgba[..., :3]
+    max_c = rgb.max(axis=-1).astype(np.uint32)
+    min_c = rgb.min(axis=-1).astype(np.uint32)
+    return np.where(max_c > 0, (max_c - min_c) * 255 // np.maximum(max_c, 1), 0).astype(np.uint8)
+
+def otsu_threshold(values):
+    """ Otsu threshold of uint8 values (maximize between-class variance) """
+    hist = np.bincount(values.ravel(), minlength=256).astype(np.float64)
+    if hist.sum() == 0:
+        return 0
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    cum_mean = np.cumsum(hist * np.arange(256))
+    mean_bg = cum_mean / np.maximum(weight_bg, 1)
+    mean_fg = (cum_mean[-1] - cum_mean) / np.maximum(weight_fg, 1)
+    between_var = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(between_var))
+
+def get_tissue_threshold(slide, tissue_threshold):
+    """
+    Saturation threshold separating tissue from glass / background.
+    tissue_threshold is either an integer (0-255) or 'otsu', computed on the lowest resolution level.
+    """
+    if tissue_threshold != "otsu":
+        return int(tissue_threshold)
+    level_lowest = slide.level_count - 1
+    thumbnail = np.asarray(slide.read_region((0, 0), level_lowest, slide.level_dimensions[level_lowest]))
+    return otsu_threshold(get_saturation(thumbnail)[thumbnail[..., 3] > 0])
+
+def screen_patches(slide, args, grid):
+    """
+    Screen the grid cells within grid['row_range'] x grid['col_range'] at the reduced level.
+    Return two arrays of shape (num_row, num_column), cells outside the ranges are left 0:
+    - nonblack: bool, True where the patch is not fully transparent / black
+    - tissue_fraction: float, fraction of reduced-level pixels with saturation above grid['tissue_threshold']
+
+    The reduced level is read once per grid row as a strip spanning the column range; each cell then
+    covers the same pixels a per-patch read_region((x,y), level_reduced, size_reduced)
+    would. A cell is black if its alpha is all 0 or its grayscale (PIL "L" conversion,
+    as in is_whole_image_black) is all 0, computed for all cells of the strip with
+    column reductions and prefix sums.
+    """
+    level_reduced = grid['level_reduced']
+    reduction_factor = get_reduction_factor(level_reduced)
+    downsample = slide.level_downsamples[level_reduced]
+    (row_start, row_end), (col_start, col_end) = grid['row_range'], grid['col_range']
+    x0 = col_start * args.patch_size
+
+    # Left / right pixel bound of each cell in the reduced strip
+    col_x = [col_idx * args.patch_size for col_idx in range(col_start, col_end)]
+    cell_left = np.array([round((x - x0) / downsample) for x in col_x])
+    cell_width = np.array([math.floor(get_patch_size(args, grid, 0, x)[1] / reduction_factor) for x in col_x])
+    cell_right = cell_left + cell_width
+    strip_width = int(cell_right.max())
+
+    nonblack = np.zeros((grid['num_row'], grid['num_column']), dtype=bool)
+    tissue_fraction = np.zeros((grid['num_row'], grid['num_column']), dtype=np.float64)
+    for row_idx in range(row_start, row_end):
+        y = row_idx * args.patch_size
+        strip_height = math.floor(get_patch_size(args, grid, y, x0)[0] / reduction_factor)
+        if strip_height == 0 or strip_width == 0:
+            # Nothing to screen at the reduced level, tile at level 0
+            nonblack[row_idx, col_start:col_end] = True
+            tissue_fraction[row_idx, col_start:col_end] = 1.0
+            continue
+        strip = np.asarray(slide.read_region((x0, y), level_reduced, (strip_width, strip_height)))
+        r, g, b, alpha = (strip[..., i].astype(np.uint32) for i in range(4))
+        gray = (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16 # ITU-R 601-2 luma, as PIL convert("L")
+        tissue = (alpha > 0) & (get_saturation(strip) > grid['tissue_threshold'])
+
+        # Per cell: any pixel with alpha > 0, any pixel with gray > 0, number of tissue pixels
+        any_alpha = np.concatenate(([0], np.cumsum((alpha > 0).any(axis=0))))
+        any_gray = np.concatenate(([0], np.cumsum((gray > 0).any(axis=0))))
+        num_tissue = np.concatenate(([0], np.cumsum(tissue.sum(axis=0))))
+        has_alpha = (any_alpha[cell_right] - any_alpha[cell_left]) > 0
+        has_gray = (any_gray[cell_right] - any_gray[cell_left]) > 0
+        nonblack[row_idx, col_start:col_end] = (has_alpha & has_gray) | (cell_width == 0)
+        cell_area = np.maximum(cell_width * strip_height, 1)
+        tissue_fraction[row_idx, col_start:col_end] = np.where(cell_width > 0, (num_tissue[cell_right] - num_tissue[cell_left]) / cell_area, 1.0)
+    return nonblack, tissue_fraction
+
+def pad_patch(args, img_array):
+    """ Pad an RGBA patch (uint8 array) read at level 0 to patch_size x patch_size with fully transparent black pixels """
+    # Pad the image with black border if the image region is smaller the patch size
+    if img_array.shape[:2] != (args.patch_size, args.patch_size):
+        img_padded = np.zeros((args.patch_size, args.patch_size, 4), np.uint8) # Fully transparent black pixels
+        img_padded[:img_array.shape[0], :img_array.shape[1]] = img_array
+        img_array = img_padded
+    return img_array
+
+def downsample_patch(args, img_array):
+    """
+    Derive the patch of every level in args.levels from a padded level 0 patch.
+    Each level is box-downsampled from the previous one with PIL Image.reduce (alpha-weighted
+    for RGBA), so level L is patch_size / 2^L px.
+    Return list of (level, RGBA array).
+    """
+    lst_level_image = []
+    level_prev, img_prev = LEVEL_HIGHEST_RES, img_array
+    for level in args.levels:
+        if level > level_prev:
+            img_reduced = Image.fromarray(img_prev, "RGBA").reduce(get_reduction_factor(level - level_prev))
+            img_prev = np.asarray(img_reduced)
+            level_prev = level
+        lst_level_image.append((level, img_prev))
+    return lst_level_image
+
+def convert_patch(img_array):
+    """
+    Lay out an RGBA patch for the encoder: a C-contiguous array. Only patches sliced out of a
+    read block are copied. The alpha channel is kept in memory and ignored by the JPEG encoders
+    (read as RGBX), so RGBA to RGB needs no extra copy.
+    """
+    return np.ascontiguousarray(img_array)
+
+class StageTimer():
+    """
+    Wall time samples (seconds) per stage of TIMING_STAGES, one sample per patch, collected by
+    the reader, encoder and writer threads of one tiling process. Samples of all processes are
+    merged with merge_stage_timings() and summarized with get_timing_stat().
+    """
+    def __init__(self):
+        self.samples = {stage: [] for stage in TIMING_STAGES}
+
+    def lap(self, stage, time_start):
+        """ Record the time since time_start for stage and return the current time """
+        time_now = time.perf_counter()
+        self.samples[stage].append(time_now - time_start) # list.append is atomic across threads
+        return time_now
+
+def merge_stage_timings(lst_samples):
+    """ Concatenate StageTimer.samples of several tiling processes """
+    return {stage: [sec for samples in lst_samples for sec in samples[stage]] for stage in TIMING_STAGES}
+
+def get_timing_stat(samples):
+    """ Per stage: count, total seconds, mean / p50 / p90 / p99 / max milliseconds """
+    lst_stat = []
+    for stage in TIMING_STAGES:
+        values = np.array(samples[stage]) * 1000
+        if len(values) == 0:
+            lst_stat.append({'stage': stage, 'count': 0, 'total_sec': 0.0, 'mean_ms': 0.0, 'p50_ms': 0.0, 'p90_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0})
+            continue
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        lst_stat.append({'stage': stage, 'count': len(values), 'total_sec': values.sum() / 1000, 'mean_ms': values.mean(),
+                         'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'max_ms': values.max()})
+    return lst_stat
+
+class PatchWritePipeline():
+    """
+    Encode and write stages of the tiler, run behind the reader (the caller of submit()).
+    - encoders: a pool of args.encode_threads threads padding / downsampling to args.levels /
+      converting / encoding patches with the args.jpeg_encoder encoder (PIL and libjpeg-turbo
+      release the GIL while encoding). Patches are RGBA uint8 arrays.
+      With 0 threads, patches are encoded on the reader thread.
+    - writer: one thread writing the encoded bytes of all levels to the output backend
+      (one file per patch, or tar shards per output folder, see patch_store.py).
+    At most args.queue_depth patches are in flight between read and write, so memory stays
+    bounded at about queue_depth x patch_size^2 x 4 bytes. The first encode / write error is
+    raised in the reader on the next submit() or on close().
+    If a checkpoint file is given, each written patch is appended to it as
+    row, col, image_name, bytes once the file is closed.
+    store_prefix names the tar shards / index of the tar backend and must be unique per pipeline.
+    If a StageTimer is given, every stage of every patch is timed; without it nothing is timed.
+    """
+    def __init__(self, args, checkpoint=None, store_prefix=None, timer=None):
+        self.args = args
+        self.checkpoint = checkpoint
+        self.timer = timer
+        self.encoder = get_encoder(args.jpeg_encoder)
+        self.num_bytes = 0 # bytes written
+        self.stores = {} # output folder -> patch store
+        self.store_prefix = store_prefix or args.op
+        self.slots = threading.BoundedSemaphore(args.queue_depth) # patches read but not written yet
+        self.write_queue = queue.Queue(maxsize=args.queue_depth)
+        self.error = None
+        self.encoders = ThreadPoolExecutor(max_workers=args.encode_threads) if args.encode_threads > 0 else None
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, cell, image_names, img_region):
+        """
+        Queue the level 0 patch of cell (row, col) for encoding and writing.
+        image_names: dict level -> output file name. Block while the pipeline is full.
+        """
+        if self.timer:
+            time_start = time.perf_counter()
+            self.slots.acquire()
+            self.timer.lap('queue_wait', time_start)
+        else:
+            self.slots.acquire()
+        self._raise_error()
+        if self.encoders:
+            self.encoders.submit(self._encode, cell, image_names, img_region)
+        else:
+            self._encode(cell, image_names, img_region)
+
+    def close(self):
+        """ Drain the pipeline and stop the writer """
+        if self.encoders:
+            self.encoders.shutdown(wait=True)
+        self.write_queue.put(None)
+        self.writer.join()
+        for store in self.stores.values():
+            store.close()
+        self._raise_error()
+
+    def _encode(self, cell, image_names, img_region):
+        try:
+            if self.timer:
+                lst_image_data = self._encode_timed(image_names, img_region)
+            else:
+                img_padded = pad_patch(self.args, img_region)
+                lst_image_data = [(image_names[level], self.encoder.encode(convert_patch(img_level), self.args.output_image_format)) for (level, img_level) in downsample_patch(self.args, img_padded)]
+        except Exception as e:
+            self.error = self.error or e
+            self.slots.release()
+            return
+        self.write_queue.put((cell, lst_image_data))
+
+    def _encode_timed(self, image_names, img_region):
+        """ Same as the untimed path of _encode, recording the pad / downsample / convert / encode times """
+        time_start = time.perf_counter()
+        img_padded = pad_patch(self.args, img_region)
+        time_start = self.timer.lap('pad', time_start)
+        lst_level_image = downsample_patch(self.args, img_padded)
+        time_start = self.timer.lap('downsample', time_start)
+        lst_level_image = [(level, convert_patch(img_level)) for (level, img_level) in lst_level_image]
+        time_start = self.timer.lap('convert', time_start)
+        lst_image_data = [(image_names[level], self.encoder.encode(img_level, self.args.output_image_format)) for (level, img_level) in lst_level_image]
+        self.timer.lap('encode', time_start)
+        return lst_image_data
+
+    def _write_loop(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                return
+            (row_idx, col_idx), lst_image_data = item
+            if self.timer:
+                time_start = time.perf_counter()
+            try:
+                for (image_name, data) in lst_image_data:
+                    if self.error is not None:
+                        break
+                    folder, name = os.path.split(image_name)
+                    if folder not in self.stores:
+                        self.stores[folder] = open_patch_store(self.args.output_backend, folder, self.store_prefix, self.args.shard_size_mb * 1024 * 1024)
+                    self.stores[folder].write(name, data)
+                    self.num_bytes += len(data)
+                    if self.checkpoint:
+                        self.checkpoint.write(f"{row_idx}\t{col_idx}\t{image_name}\t{len(data)}\n")
+                        self.checkpoint.flush()
+            except Exception as e: # Keep draining the queue, the error is raised by the next submit() or close()
+                self.error = self.error or e
+            finally:
+                if self.timer:
+                    self.timer.lap('write', time_start)
+                self.slots.release()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+def get_output_folder(args, level=LEVEL_HIGHEST_RES):
+    """ Output folder of the patches of a level: {outdir}/{op} for level 0, {outdir}/{op}.lv{level} otherwise """
+    if level == LEVEL_HIGHEST_RES:
+        return Path(args.outdir) / args.op
+    return Path(args.outdir) / f"{args.op}.lv{level}"
+
+def get_image_name(args, grid, row_idx, col_idx, y, x, level=LEVEL_HIGHEST_RES):
+    """ Output file name of a patch: {output_folder}/{op}.{row}_{col}.{y}_{x}.{ext}, with (y, x) the level 0 offset """
+    image_prefix = f"{args.op}.{row_idx:0{grid['zeropad_row']}d}_{col_idx:0{grid['zeropad_column']}d}.{y}_{x}"
+    ext = get_image_file_extension(args.output_image_format)
+    return f"{get_output_folder(args, level)}/{image_prefix}.{ext}"
+
+def get_read_block_bytes(args):
+    """
+    Max size of one read block: half of args.read_block_mb, since converting a block read by OpenSlide
+    to a NumPy array briefly holds two copies of it
+    """
+    return int(args.read_block_mb * 1024 ** 2) // 2
+
+def get_read_block_rows(args, grid):
+    """ Grid rows per coalesced read: as many ROI-wide rows as fit in one read block, at least 1 """
+    row_bytes = (grid['col_range'][1] - grid['col_range'][0]) * args.patch_size ** 2 * 4 # RGBA
+    return max(1, get_read_block_bytes(args) // row_bytes)
+
+def read_blocks(slide, args, grid, todo, row_start, row_end, timer=None):
+    """
+    Read the level 0 pixels of the cells to tile (todo) in grid rows [row_start, row_end) with few read_region calls.
+    Adjacent columns holding cells to tile are grouped into runs; each run is read as one block spanning
+    the rows of its cells, split into several blocks of adjacent columns if it exceeds the read block size
+    (get_read_block_bytes). Level 0 is read without resampling, so a patch cropped from a block is identical
+    to a patch read on its own. With a zero budget every cell is its own block, i.e. one read_region per patch.
+    Generator: yield (block RGBA array, block x, block y, [(row_idx, col_idx) of the cells to tile in the block])
+    one block at a time, in row/col order within the block. The next block is only read when the caller
+    asks for it, so only one block is held by the reader at a time.
+    """
+    col_start = grid['col_range'][0]
+    todo_cols = todo[row_start:row_end, col_start:grid['col_range'][1]].any(axis=0)
+    cell_bytes = args.patch_size ** 2 * 4 # RGBA
+    col_idx = 0
+    while col_idx < len(todo_cols):
+        if not todo_cols[col_idx]:
+            col_idx += 1
+            continue
+        # Run of adjacent columns with cells to tile
+        run_end = col_idx
+        while run_end < len(todo_cols) and todo_cols[run_end]:
+            run_end += 1
+        todo_rows = np.nonzero(todo[row_start:row_end, col_start + col_idx:col_start + run_end].any(axis=1))[0]
+        block_row_start, block_row_end = row_start + todo_rows[0], row_start + todo_rows[-1] + 1
+        block_cols = max(1, get_read_block_bytes(args) // (cell_bytes * (block_row_end - block_row_start)))
+        for block_col_start in range(col_start + col_idx, col_start + run_end, block_cols):
+            block_col_end = min(block_col_start + block_cols, col_start + run_end)
+            # Block bounds in level 0, clipped to the slide like the patches
+            block_x, block_y = block_col_start * args.patch_size, block_row_start * args.patch_size
+            block_width = min(block_col_end * args.patch_size, grid['slide_dimensions'][0]) - block_x
+            block_height = min(block_row_end * args.patch_size, grid['slide_dimensions'][1]) - block_y
+            if timer:
+                time_start = time.perf_counter()
+            ## OpenSlide.region_region: (x,y) is the top left pixel in the level 0 reference frame
+            img_block = slide.read_region((block_x, block_y), LEVEL_HIGHEST_RES, (block_width, block_height))
+            if timer:
+                timer.lap('read', time_start)
+            assert img_block.getbands() == ('R', 'G', 'B', 'A')
+            img_block = np.asarray(img_block) # patches are sliced from this array as views
+            cells = [(block_row_start + row_idx, block_col_start + block_col_idx)
+                     for (row_idx, block_col_idx) in zip(*np.nonzero(todo[block_row_start:block_row_end, block_col_start:block_col_end]))]
+            yield img_block, block_x, block_y, cells
+            del img_block # Release the block before reading the next one
+        col_idx = run_end
+
+def tile_patch(pipeline, args, grid, row_idx, col_idx, y, x, cell_block):
+    """
+    Slice the level 0 patch of a grid cell that passed screening out of its read block (see read_blocks)
+    and queue it for encoding and writing at every level of args.levels.
+    Return the image file name of the finest level.
+    """
+    patch_size_y, patch_size_x = get_patch_size(args, grid, y, x)
+    img_block, block_x, block_y = cell_block
+    img_region = img_block[y - block_y:y - block_y + patch_size_y, x - block_x:x - block_x + patch_size_x] # view, no copy
+
+    image_names = {level: get_image_name(args, grid, row_idx, col_idx, y, x, level) for level in args.levels}
+    pipeline.submit((row_idx, col_idx), image_names, img_region)
+    return image_names[args.levels[0]]
+
+def get_checkpoint_folder(args):
+    return get_output_folder(args) / CHECKPOINT_FOLDER
+
+def remove_checkpoint(args):
+    """ Remove the checkpoint folder once the manifest and log of the slide are written; a failed run keeps it for --resume """
+    shutil.rmtree(get_checkpoint_folder(args))
+
+def is_slide_tiled(args):
+    """ True if a previous run tiled the slide to the end: its manifest is written and its checkpoint removed """
+    return get_manifest_file(args, args.levels[0]).exists() and not get_checkpoint_folder(args).exists()
+
+def get_checkpoint_params(args):
+    """ Run parameters that must not change between a run and its resume """
+    return {
+        'mrxs': os.path.abspath(args.mrxs),
+        'patch_size': args.patch_size,
+        'output_image_format': args.output_image_format,
+        'levels': args.levels,
+        'roi': args.roi,
+        'output_backend': args.output_backend,
+        'tissue_threshold': args.tissue_threshold,
+        'min_tissue_fraction': args.min_tissue_fraction,
+    }
+
+def is_valid_patch(data, num_bytes):
+    """ Check patch bytes read back from the output backend have the checkpointed size and can be read as an image """
+    if data is None or len(data) != num_bytes:
+        return False
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.verify()
+        return True
+    except (OSError, SyntaxError): # PIL raises SyntaxError on some corrupted files
+        return False
+
+def load_checkpoint(args):
+    """
+    Read the checkpoint files of previous runs (one per tiling process) and return
+    the set of patch file names that are still valid in the output backend.
+    """
+    checkpoint_entries = {} # image_name -> bytes
+    for checkpoint_file in sorted(get_checkpoint_folder(args).glob("*.tsv")):
+        with open(checkpoint_file, 'r', encoding="utf-8") as fin:
+            for line in fin:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 4 or not (fields[0].isdigit() and fields[1].isdigit() and fields[3].isdigit()):
+                    continue # Line torn by an interruption
+                checkpoint_entries[fields[2]] = int(fields[3])
+
+    readers = {} # output folder -> patch store reader
+    for image_name in checkpoint_entries:
+        folder = os.path.dirname(image_name)
+        if folder not in readers:
+            readers[folder] = open_patch_store_reader(args.output_backend, folder)
+
+    def check_entry(image_name):
+        folder, name = os.path.split(image_name)
+        return is_valid_patch(readers[folder].read(name), checkpoint_entries[image_name])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        lst_is_valid = list(executor.map(check_entry, checkpoint_entries))
+    for reader in readers.values():
+        reader.close()
+    return {image_name for (image_name, is_valid) in zip(checkpoint_entries, lst_is_valid) if is_valid}
+
+def get_manifest_file(args, level=LEVEL_HIGHEST_RES):
+    return get_output_folder(args, level) / f"{args.op}.manifest.tsv"
+
+def get_manifest_patch(args, grid, row_idx, col_idx, image_name):
+    """ Manifest row (MANIFEST_COLUMNS, level 0 patch sizes) of a grid cell; image_name is '.' for a cell whose patch is not written """
+    y, x = row_idx * args.patch_size, col_idx * args.patch_size
+    patch_size_y, patch_size_x = get_patch_size(args, grid, y, x)
+    is_black = not grid['nonblack'][row_idx, col_idx]
+    return {'image_name': os.path.basename(image_name), 'row': row_idx, 'col': col_idx, 'y_offset': y, 'x_offset': x,
+            'patch_size_y': patch_size_y, 'patch_size_x': patch_size_x, 'is_black': is_black,
+            'is_background': (not is_black) and (not grid['mask'][row_idx, col_idx]),
+            'tissue_fraction': float(grid['tissue_fraction'][row_idx, col_idx])}
+
+def get_manifest_part_file(args, grid, row_start, row_end):
+    return get_checkpoint_folder(args) / f"manifest.{row_start:0{grid['zeropad_row']}d}-{row_end - 1:0{grid['zeropad_row']}d}.tsv"
+
+def tile_row_band(args, grid, timestamp, row_start, row_end):
+    """
+    Tile grid rows [row_start, row_end) with a dedicated OpenSlide handle.
+    Only cells marked in grid['mask'] (non-black with enough tissue) are read at level 0 (in coalesced
+    blocks of up to args.read_block_mb / 2 MB read one at a time, see read_blocks),
+    except cells marked in grid['done'] whose patches were already written by a previous run;
+    black and background cells are recorded with image name '.'.
+    Used by the serial path (whole grid as one band) and by each worker process.
+    Every cell of the ROI is streamed to the band's manifest part file (MANIFEST_COLUMNS, level 0 patch sizes) once the rows of its read group are tiled.
+    Tar shards / index of the band are named {op}.{timestamp}.{rows}, timestamp being the run timestamp shared by all bands.
+    With --progress_sec, a progress line is printed at most every progress_sec seconds.
+    Return the patch counts and bytes written of the band, and the stage timings with --timings.
+    """
+    band_stat = {'num_patches': 0, 'num_black_patch': 0, 'num_background_patch': 0, 'num_tiled_patch': 0, 'num_bytes': 0}
+    timer = StageTimer() if args.timings else None
+    band_name = f"{args.op} rows {row_start}-{row_end - 1}"
+    todo = grid['mask'] & ~grid['done']
+    num_todo = int(todo[row_start:row_end].sum())
+    read_block_rows = get_read_block_rows(args, grid)
+    time_start = time_progress = time.perf_counter()
+    checkpoint_file = get_checkpoint_folder(args) / f"{os.getpid()}.tsv"
+    # Later runs sort after earlier ones, so the tar index of a resumed run takes precedence
+    store_prefix = f"{args.op}.{timestamp}.{row_start:0{grid['zeropad_row']}d}-{row_end - 1:0{grid['zeropad_row']}d}"
+    with openslide.OpenSlide(args.mrxs) as slide, \
+            open(checkpoint_file, 'a', encoding="utf-8") as checkpoint, \
+            open(get_manifest_part_file(args, grid, row_start, row_end), 'w', encoding="utf-8") as manifest, \
+            PatchWritePipeline(args, checkpoint, store_prefix, timer) as pipeline:
+        for group_start in range(row_start, row_end, read_block_rows):
+            group_end = min(group_start + read_block_rows, row_end)
+            # Tile the cells of each coalesced block as soon as it is read; the block is released
+            # (apart from patches still in the pipeline) before the next one is read
+            for (img_block, block_x, block_y, cells) in read_blocks(slide, args, grid, todo, group_start, group_end, timer):
+                for (row_idx, col_idx) in cells:
+                    tile_patch(pipeline, args, grid, row_idx, col_idx, row_idx * args.patch_size, col_idx * args.patch_size, (img_block, block_x, block_y))
+                    band_stat['num_tiled_patch'] += 1
+                    if args.progress_sec and time.perf_counter() - time_progress >= args.progress_sec:
+                        time_progress = time.perf_counter()
+                        print(f"Progress [{band_name}]: {band_stat['num_tiled_patch']}/{num_todo} patches, "
+                              f"{band_stat['num_tiled_patch'] / (time_progress - time_start):.1f} patches/s, "
+                              f"{pipeline.num_bytes / 1024 ** 2 / (time_progress - time_start):.1f} MB/s written", flush=True)
+                del img_block
+            # Manifest of the rows of the group, in row/col order
+            for row_idx in range(group_start, group_end):
+                for col_idx in range(*grid['col_range']):
+                    image_name = '.'
+                    if grid['mask'][row_idx, col_idx]: # Tiled now, or written by a previous run (grid['done'])
+                        image_name = get_image_name(args, grid, row_idx, col_idx, row_idx * args.patch_size, col_idx * args.patch_size, args.levels[0])
+                    patch = get_manifest_patch(args, grid, row_idx, col_idx, image_name)
+                    manifest.write(format_manifest_line(patch))
+                    band_stat['num_patches'] += 1
+                    band_stat['num_black_patch'] += int(patch['is_black'])
+                    band_stat['num_background_patch'] += int(patch['is_background'])
+    band_stat['num_bytes'] = pipeline.num_bytes
+    if timer:
+        band_stat['timings'] = timer.samples
+    return band_stat
+
+def split_row_bands(row_range, num_bands):
+    """ Split rows [row_range[0], row_range[1]) into at most num_bands contiguous (row_start, row_end) bands """
+    num_row = row_range[1] - row_range[0]
+    num_bands = max(1, min(num_bands, num_row))
+    band_size = math.ceil(num_row / num_bands)
+    return [(row_start, min(row_start + band_size, row_range[1])) for row_start in range(row_range[0], row_range[1], band_size)]
+
+def get_row_bands(args, grid):
+    """ Row bands of the grid: one band for the serial run, several bands per worker otherwise """
+    if args.workers > 1:
+        # Several bands per worker keep the pool balanced when tissue is unevenly distributed
+        return split_row_bands(grid['row_range'], args.workers * 4)
+    return [grid['row_range']]
+
+def get_level_patch_size(patch_size, level):
+    """ Valid size at a level of a patch side of patch_size level 0 pixels, as left by downsample_patch """
+    return math.ceil(patch_size / get_reduction_factor(level))
+
+def merge_row_bands(args, grid, row_bands, lst_band_stat):
+    """
+    Concatenate the band manifest parts in band order into the manifest of every output folder,
+    so the manifest comes out in the same row/col order as the serial path.
+    Every level folder has the same patch names, with the patch sizes of its level.
+    Return the summed patch counts.
+    """
+    with ExitStack() as stack:
+        manifests = {level: stack.enter_context(open(get_manifest_file(args, level), 'w', encoding="utf-8")) for level in args.levels}
+        for manifest in manifests.values():
+            manifest.write("\t".join(MANIFEST_COLUMNS) + "\n")
+        for (row_start, row_end) in row_bands:
+            part_file = get_manifest_part_file(args, grid, row_start, row_end)
+            with open(part_file, 'r', encoding="utf-8") as fin:
+                for line in fin:
+                    patch = parse_manifest_line(line) # Level 0 patch sizes
+                    for (level, manifest) in manifests.items():
+                        manifest.write(format_manifest_line(dict(patch, patch_size_y=get_level_patch_size(patch['patch_size_y'], level),
+                                                                 patch_size_x=get_level_patch_size(patch['patch_size_x'], level))))
+            os.remove(part_file)
+
+    patch_stat = {k: sum(band_stat[k] for band_stat in lst_band_stat) for k in lst_band_stat[0] if k != 'timings'}
+    if args.timings:
+        patch_stat['timings'] = merge_stage_timings([band_stat['timings'] for band_stat in lst_band_stat])
+    return patch_stat
+
+def tile_row_bands(args, grid, timestamp):
+    """ Tile the grid, either serially as one band or in row bands across a process pool. Return the summed patch counts. """
+    row_bands = get_row_bands(args, grid)
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(tile_row_band, args, grid, timestamp, row_start, row_end) for (row_start, row_end) in row_bands]
+            lst_band_stat = [future.result() for future in futures]
+    else:
+        lst_band_stat = [tile_row_band(args, grid, timestamp, *row_bands[0])]
+    return merge_row_bands(args, grid, row_bands, lst_band_stat)
+
+def check_args(args):
+    """ Check the tiling options shared by all slides; raise ValueError if invalid """
     # Check if output directory exist
     if not Path(args.outdir).is_dir():
-        sys.exit(f"ERROR: Output folder [{args.outdir}] does not exist!")
+        raise ValueError(f"Output folder [{args.outdir}] does not exist!")
+
+    if args.workers < 1:
+        raise ValueError(f"--workers must be >= 1 (got {args.workers})!")
+
+    if args.encode_threads < 0:
+        raise ValueError(f"--encode_threads must be >= 0 (got {args.encode_threads})!")
+
+    if args.queue_depth < 1:
+        raise ValueError(f"--queue_depth must be >= 1 (got {args.queue_depth})!")
+
+    if args.patch_size % get_reduction_factor(args.levels[-1]) != 0:
+        raise ValueError(f"--patch_size {args.patch_size} is not divisible by the reduction factor of level {args.levels[-1]}!")
+
+    if args.tissue_threshold != "otsu" and not (args.tissue_threshold.isdigit() and 0 <= int(args.tissue_threshold) <= 255):
+        raise ValueError(f"--tissue_threshold must be 'otsu' or an integer in 0-255 (got {args.tissue_threshold})!")
+
+    if not 0 <= args.min_tissue_fraction <= 1:
+        raise ValueError(f"--min_tissue_fraction must be in [0, 1] (got {args.min_tissue_fraction})!")
+
+    get_encoder(args.jpeg_encoder) # Check the optional encoder is installed
+
+def create_output_folders(args):
+    """
+    In output directory, create folder named args.op (and args.op.lv<level> for level > 0).
+    With --resume, existing folders are reused if they were created with the same parameters.
+    Raise ValueError if the folders cannot be used.
+    """
+    # Check if input MRXS exists
+    if not Path(args.mrxs).exists():
+        raise ValueError(f"Input MRSX file [{args.mrxs}] does not exist!")
 
-    # In output directory, create folder named args.output_image_prefix.
-    output_folder = Path(args.outdir) / args.op
+    output_folder = get_output_folder(args)
+    checkpoint_folder = get_checkpoint_folder(args)
+    checkpoint_params_file = checkpoint_folder / "params.json"
+    if not args.resume:
+        for level in sorted(set(args.levels) | {LEVEL_HIGHEST_RES}):
+            if get_output_folder(args, level).is_dir():
+                raise ValueError(f"Output directory [{get_output_folder(args, level)} already exist!")
     if output_folder.is_dir():
-        sys.exit(f"ERROR: Output directory [{output_folder} already exist!")
-    os.mkdir(output_folder)
+        if is_slide_tiled(args):
+            raise ValueError(f"Output directory [{output_folder}] is already tiled, nothing to resume!")
+        if not checkpoint_params_file.exists():
+            raise ValueError(f"Cannot resume, no checkpoint found in output directory [{output_folder}]!")
+        checkpoint_params = json.load(open(checkpoint_params_file, 'r', encoding="utf-8"))
+        if checkpoint_params != get_checkpoint_params(args):
+            raise ValueError(f"Cannot resume, run parameters differ from the checkpoint: {checkpoint_params}")
+    else:
+        os.mkdir(output_folder)
+        os.mkdir(checkpoint_folder)
+        with open(checkpoint_params_file, 'w', encoding="utf-8") as fout:
+            json.dump(get_checkpoint_params(args), fout, indent=2)
+    for level in args.levels:
+        get_output_folder(args, level).mkdir(exist_ok=True)
 
-    #------------------------------------------
-    # Main
-    #------------------------------------------
+def get_grid(args, slide):
+    """
+    Build the patch grid of a slide and screen it at the reduced level.
+    The grid always starts at (0, 0) of level 0, so row / column indices and offsets do not depend
+    on the ROI; only the grid cells overlapping the ROI (row_range x col_range) are tiled.
+    Raise ValueError if the ROI does not overlap the slide.
+    """
+    # Region of interest in level 0 coordinates
+    (roi_x, roi_y, roi_width, roi_height) = get_roi(slide, args.roi)
+
+    # Number of image patches
+    num_row = math.ceil(slide.dimensions[1] / args.patch_size)
+    num_column = math.ceil(slide.dimensions[0] / args.patch_size)
+
+    grid = {
+        'slide_dimensions': slide.dimensions,
+        'roi': (roi_x, roi_y, roi_width, roi_height),
+        'num_row': num_row,
+        'num_column': num_column,
+        'row_range': (roi_y // args.patch_size, math.ceil((roi_y + roi_height) / args.patch_size)),
+        'col_range': (roi_x // args.patch_size, math.ceil((roi_x + roi_width) / args.patch_size)),
+        # Zero-pad patch and region idx
+        'zeropad_row': len(str(num_row)),
+        'zeropad_column': len(str(num_column)),
+        # image level for screening black image
+        'level_reduced': min(4, slide.level_count - 1),
+        'tissue_threshold': get_tissue_threshold(slide, args.tissue_threshold),
+    }
+
+    # Screen all grid cells for black / transparent content and tissue fraction in one pass at the reduced level
+    time_start = time.perf_counter()
+    grid['nonblack'], grid['tissue_fraction'] = screen_patches(slide, args, grid)
+    grid['time_screen_sec'] = time.perf_counter() - time_start
+    grid['mask'] = grid['nonblack'] & (grid['tissue_fraction'] >= args.min_tissue_fraction)
+    return grid
+
+def save_mask(args, timestamp, mask):
+    """
+    Save the mask of the cells to tile (non-black and tissue fraction >= args.min_tissue_fraction) as
+    {op}.image_patches.{timestamp}.mask.npy in the current folder. On resume, the latest mask file of
+    the slide is reused if it holds the same mask. Return the mask file name.
+    """
+    if args.resume:
+        mask_files = sorted(Path(".").glob(f"{args.op}.image_patches.*.mask.npy"))
+        if mask_files and np.array_equal(np.load(mask_files[-1]), mask):
+            return str(mask_files[-1])
+    mask_file = f"{args.op}.image_patches.{timestamp}.mask.npy"
+    np.save(mask_file, mask)
+    return mask_file
+
+def prepare_slide(args):
+    """
+    Create the output folders, build the grid and screen it. Return (timestamp, grid, log_entries).
+    Raise ValueError for unusable output folders or ROI.
+    """
+    create_output_folders(args)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    
+
     # Open MRXS
-    slide = openslide.OpenSlide(args.mrxs)
-
-    log_entries = {}
-    log_entries['mrxs'] = args.mrxs
-    log_entries['output_directory'] = str(output_folder)
-    log_entries['patch_size'] = args.patch_size
-    log_entries['image_format'] = args.output_image_format
-    log_entries['level_count'] = slide.level_count
-    for level in range(slide.level_count):
-        log_entries[f"dimension_lv{level}"] = slide.level_dimensions[level]
-
-    LEVEL_HIGHEST_RES = 0
-    ROI_UPPER_LEFT_LV0 = (0, 0)
-    ROI_LOWER_RIGHT_LV0 = slide.dimensions
-    ROI_size_x = ROI_LOWER_RIGHT_LV0[0] - ROI_UPPER_LEFT_LV0[0]
-    ROI_size_y = ROI_LOWER_RIGHT_LV0[1] - ROI_UPPER_LEFT_LV0[1]
-
-    # image level for screening black image
-    level_reduced = 4
-    reduction_factor = get_reduction_factor(level_reduced)
+    with openslide.OpenSlide(args.mrxs) as slide:
+        grid = get_grid(args, slide)
 
-    # Number of image patches
-    num_row = math.ceil(ROI_size_y / args.patch_size)
-    num_column = math.ceil(ROI_size_x / args.patch_size)
-    num_patches = num_row * num_column
-    log_entries['num_row'] = num_row
-    log_entries['num_column'] = num_column
-    log_entries['num_patches'] = num_patches
-
-    # Zero-pad patch and region idx
-    zeropad_row = len(str(num_row))
-    zeropad_column = len(str(num_column))
-
-    num_patch_black = 0 
-    num_patch_xblack = 0 
-
-    lst_image_stat = []
-    for row_idx, y in enumerate(range(ROI_UPPER_LEFT_LV0[1], ROI_LOWER_RIGHT_LV0[1], args.patch_size)):
-        for col_idx, x in enumerate(range(ROI_UPPER_LEFT_LV0[0], ROI_LOWER_RIGHT_LV0[0], args.patch_size)):
-            image_prefix = f"{args.op}.{row_idx:0{zeropad_row}d}_{col_idx:0{zeropad_column}d}.{y}_{x}"
-
-            # Valid patch size
-            patch_size_x = min(args.patch_size, slide.dimensions[0] - x)
-            patch_size_y = min(args.patch_size, slide.dimensions[1] - y)
-
-            # Skip if the image patch is fully transparent / black at lower resolution
-            patch_size_x_reduced = math.floor(patch_size_x / reduction_factor)
-            patch_size_y_reduced = math.floor(patch_size_y / reduction_factor)
-            img_reduced = slide.read_region((x,y), level_reduced, (patch_size_x_reduced, patch_size_y_reduced)) 
-            is_black = None
-            if is_whole_image_black(img_reduced):
-                is_black = True
-                num_patch_black += 1
-                image_name = '.'
-            else:
-                is_black = False
-                num_patch_xblack += 1 
-
-                # Obtain the image patch in highest resoluion
-                ## OpenSlide.region_region: (x,y) is the top left pixel in the level 0 reference frame
-                img_region = slide.read_region((x,y), LEVEL_HIGHEST_RES, (patch_size_x, patch_size_y)) 
-                assert img_region.getbands() == ('R', 'G', 'B', 'A')
-
-                # Pad the image with black border if the image region is smaller the patch size
-                if (patch_size_x < args.patch_size) or (patch_size_y < args.patch_size):
-                    img_padded = Image.new("RGBA", (args.patch_size, args.patch_size), (0, 0, 0, 0)) # Fully transparent black pixels
-                    img_padded.paste(img_region, (0, 0)) # Paste the original image
-                    img_region = img_padded
-
-                # Save image to file
-                ext = get_image_file_extension(args.output_image_format)
-                image_name = f"{args.outdir}/{args.op}/{image_prefix}.{ext}"
-                if args.output_image_format in ("JPEG", "JPEG-low"): #RGB
-                    img_region = img_region.convert("RGB") # Convert RGBA to RGB
-                    if args.output_image_format == "JPEG":
-                        img_region.save(image_name, format='JPEG', quality=100, subsampling=0)
-                    elif args.output_image_format == "JPEG-low":
-                        img_region.save(image_name, format='JPEG')            
-                elif args.output_image_format == "TIFF": #RGBA
-                    img_region.save(image_name, format='TIFF')
-                elif args.output_image_format == "PNG": #RGBA
-                    img_region.save(image_name, format='PNG')
-                else:
-                    raise ValueError("Output format not supported.")
-            lst_image_stat.append((image_name, row_idx, col_idx, y, x, patch_size_y, patch_size_x, int(is_black)))
-        log_entries['num_black_patch'] = num_patch_black
-        log_entries['num_non_black_patch'] = num_patch_xblack
-    slide.close()
+        log_entries = {}
+        log_entries['mrxs'] = args.mrxs
+        log_entries['output_directory'] = str(get_output_folder(args))
+        log_entries['levels'] = ",".join(str(level) for level in args.levels)
+        for level in args.levels:
+            if level != LEVEL_HIGHEST_RES:
+                log_entries[f"output_directory_lv{level}"] = str(get_output_folder(args, level))
+        log_entries['patch_size'] = args.patch_size
+        log_entries['image_format'] = args.output_image_format
+        log_entries['output_backend'] = args.output_backend
+        log_entries['level_count'] = slide.level_count
+        for level in range(slide.level_count):
+            log_entries[f"dimension_lv{level}"] = slide.level_dimensions[level]
 
-    #------------------------------------------
-    # Write log file
-    #------------------------------------------
-    with open(f"{args.op}.image_patches.{timestamp}.log", 'w', encoding="utf-8") as fout:
+    (row_start, row_end), (col_start, col_end) = grid['row_range'], grid['col_range']
+    log_entries['roi'] = args.roi
+    log_entries['roi_lv0'] = grid['roi']
+    log_entries['num_row'] = grid['num_row']
+    log_entries['num_column'] = grid['num_column']
+    log_entries['roi_row_range'] = f"{row_start}-{row_end - 1}"
+    log_entries['roi_col_range'] = f"{col_start}-{col_end - 1}"
+    log_entries['num_patches'] = (row_end - row_start) * (col_end - col_start)
+    log_entries['tissue_threshold'] = grid['tissue_threshold']
+    log_entries['min_tissue_fraction'] = args.min_tissue_fraction
+    log_entries['time_screen_sec'] = f"{grid['time_screen_sec']:.2f}"
+
+    # Patches completed by a previous run, with a valid file on disk
+    grid['done'] = np.zeros_like(grid['mask'])
+    if args.resume:
+        valid_image_names = load_checkpoint(args)
+        for (row_idx, col_idx) in zip(*np.nonzero(grid['mask'])):
+            y = row_idx * args.patch_size
+            x = col_idx * args.patch_size
+            grid['done'][row_idx, col_idx] = all(get_image_name(args, grid, row_idx, col_idx, y, x, level) in valid_image_names for level in args.levels)
+        print(f"Resume: {args.op}: {int((grid['done'] & grid['mask']).sum())} of {int(grid['mask'].sum())} patches already done.")
+    log_entries['mask_level'] = grid['level_reduced']
+    log_entries['mask_file'] = save_mask(args, timestamp, grid['mask'])
+    return timestamp, grid, log_entries
+
+def write_slide_log(args, timestamp, log_entries, patch_stat):
+    """
+    Add the patch counts, bytes written and throughput to log_entries and write the slide log file.
+    patch_stat['time_tiling_sec'] is the wall time from the start of tiling to the last band done.
+    With --timings, the per-stage timings are written in a [Stage timings] section.
+    Return the log file name.
+    """
+    log_entries['manifest'] = str(get_manifest_file(args, args.levels[0]))
+    log_entries['num_black_patch'] = patch_stat['num_black_patch']
+    log_entries['num_non_black_patch'] = patch_stat['num_patches'] - patch_stat['num_black_patch']
+    log_entries['num_background_patch'] = patch_stat['num_background_patch']
+    log_entries['num_tiled_patch'] = patch_stat['num_tiled_patch'] # read and written by this run
+    log_entries['bytes_written'] = patch_stat['num_bytes']
+    log_entries['time_tiling_sec'] = f"{patch_stat['time_tiling_sec']:.2f}"
+    log_entries['patches_per_sec'] = f"{patch_stat['num_tiled_patch'] / max(patch_stat['time_tiling_sec'], 1e-9):.2f}"
+
+    log_file = f"{args.op}.image_patches.{timestamp}.log"
+    with open(log_file, 'w', encoding="utf-8") as fout:
         fout.write("Logs: MRXS to image patches\n")
         fout.write("[Summary]\n")
         fout.write(f"Timestamp\t{timestamp}\n")
         for k,v in log_entries.items():
             fout.write(f"{k}\t{v}\n")
+        if args.timings:
+            # Summed over threads and worker processes, so totals can exceed the wall time
+            fout.write("\n[Stage timings]\n")
+            fout.write("\t".join(['stage', 'count', 'total_sec', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']) + '\n')
+            for stat in get_timing_stat(patch_stat['timings']):
+                fout.write(f"{stat['stage']}\t{stat['count']}\t{stat['total_sec']:.3f}\t{stat['mean_ms']:.3f}\t{stat['p50_ms']:.3f}\t{stat['p90_ms']:.3f}\t{stat['p99_ms']:.3f}\t{stat['max_ms']:.3f}\n")
         fout.write("\n[Patch information]\n")
-        fout.write("\t".join(['image_name', 'row', 'column', 'x_offset', 'y_offset', 'patch_size_y', 'patch_size_x', 'is_black']) + '\n')
-        for (image_prefix, row_idx, col_idx, y, x, patch_size_y, patch_size_x, is_black) in lst_image_stat:
-            fout.write(f"{image_prefix}\t{row_idx}\t{col_idx}\t{y}\t{x}\t{patch_size_y}\t{patch_size_x}\t{is_black}\n")
+        fout.write("\t".join(['image_name', 'row', 'column', 'x_offset', 'y_offset', 'patch_size_y', 'patch_size_x', 'is_black', 'is_background', 'tissue_fraction']) + '\n')
+        for patch in read_manifest(get_manifest_file(args, args.levels[0])):
+            image_name = patch['image_name'] if patch['image_name'] == '.' else f"{get_output_folder(args, args.levels[0])}/{patch['image_name']}"
+            fout.write(f"{image_name}\t{patch['row']}\t{patch['col']}\t{patch['y_offset']}\t{patch['x_offset']}\t{patch['patch_size_y']}\t{patch['patch_size_x']}\t{patch['is_black']}\t{patch['is_background']}\t{patch['tissue_fraction']:.4f}\n")
+    return log_file
+
+def get_batch_slides(args):
+    """ MRXS files of a batch run, from --mrxs_dir (*.mrxs) or --mrxs_list (one path per line) """
+    if args.mrxs_dir:
+        if not Path(args.mrxs_dir).is_dir():
+            raise ValueError(f"Input folder [{args.mrxs_dir}] does not exist!")
+        return sorted(str(mrxs) for mrxs in Path(args.mrxs_dir).glob("*.mrxs"))
+    with open(args.mrxs_list, 'r', encoding="utf-8") as fin:
+        return [line.strip() for line in fin if line.strip() and not line.startswith("#")]
+
+def get_slide_args(args, mrxs):
+    """ Per-slide copy of the arguments; op is the slide file name without extension """
+    slide_args = argparse.Namespace(**vars(args))
+    slide_args.mrxs = mrxs
+    slide_args.op = Path(mrxs).stem
+    return slide_args
+
+def tile_batch(args):
+    """
+    Tile a batch of slides over one shared process pool.
+    Slides are scheduled largest first by level 0 area: each slide is screened in the main process
+    and its row bands are queued on the pool, so the pool keeps tiling the bands of earlier slides
+    while the next slide is screened. A slide that fails is reported and the others continue.
+    Each slide gets its usual log; a run summary image_patches.batch.{timestamp}.log lists every slide.
+    With --resume, slides already tiled to the end are skipped.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    time_start = datetime.now()
+    lst_slide = [] # dict per slide, in schedule order
+    for mrxs in get_batch_slides(args):
+        slide_args = get_slide_args(args, mrxs)
+        slide_info = {'mrxs': mrxs, 'op': slide_args.op, 'args': slide_args, 'area': 0, 'status': 'failed', 'error': ''}
+        try:
+            with openslide.OpenSlide(mrxs) as slide:
+                slide_info['area'] = slide.dimensions[0] * slide.dimensions[1]
+        except Exception as e:
+            slide_info['error'] = f"{type(e).__name__}: {e}"
+        lst_slide.append(slide_info)
+    ops = [slide_info['op'] for slide_info in lst_slide]
+    for slide_info in lst_slide:
+        if ops.count(slide_info['op']) > 1:
+            slide_info['error'] = f"Duplicate slide name {slide_info['op']}"
+            slide_info['area'] = 0
+    lst_slide.sort(key=lambda slide_info: -slide_info['area'])
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # Screen slides and queue their row bands
+        for slide_info in lst_slide:
+            if slide_info['error']:
+                print(f"ERROR: {slide_info['mrxs']}: {slide_info['error']}")
+                continue
+            slide_args = slide_info['args']
+            if slide_args.resume and is_slide_tiled(slide_args):
+                slide_info['status'] = 'skipped'
+                print(f"Skip {slide_info['op']}: already tiled.")
+                continue
+            try:
+                slide_info['timestamp'], slide_info['grid'], slide_info['log_entries'] = prepare_slide(slide_args)
+            except Exception as e:
+                slide_info['error'] = f"{type(e).__name__}: {e}"
+                print(f"ERROR: {slide_info['mrxs']}: {slide_info['error']}")
+                continue
+            slide_info['row_bands'] = get_row_bands(slide_args, slide_info['grid'])
+            slide_info['futures'] = [executor.submit(tile_row_band, slide_args, slide_info['grid'], slide_info['timestamp'], row_start, row_end) for (row_start, row_end) in slide_info['row_bands']]
+            slide_info['time_start'] = slide_info['time_end'] = time.perf_counter()
+            for future in slide_info['futures']:
+                future.add_done_callback(lambda _, slide_info=slide_info: slide_info.update(time_end=max(slide_info['time_end'], time.perf_counter())))
+            print(f"Queued {slide_info['op']}: {len(slide_info['row_bands'])} row bands, {int(slide_info['grid']['mask'].sum())} patches to tile.")
+
+        # Collect slides in schedule order and write their logs
+        for slide_info in lst_slide:
+            if 'futures' not in slide_info:
+                continue
+            slide_args = slide_info['args']
+            try:
+                lst_band_stat = [future.result() for future in slide_info['futures']]
+                patch_stat = merge_row_bands(slide_args, slide_info['grid'], slide_info['row_bands'], lst_band_stat)
+                patch_stat['time_tiling_sec'] = slide_info['time_end'] - slide_info['time_start']
+                slide_info['num_tiled_patch'] = patch_stat['num_tiled_patch']
+                slide_info['log_file'] = write_slide_log(slide_args, slide_info['timestamp'], slide_info['log_entries'], patch_stat)
+                remove_checkpoint(slide_args)
+                slide_info['status'] = 'done'
+                print(f"Done {slide_info['op']}: {slide_info['log_file']}")
+            except Exception as e:
+                slide_info['error'] = f"{type(e).__name__}: {e}"
+                print(f"ERROR: {slide_info['mrxs']}: {slide_info['error']}")
+
+    #------------------------------------------
+    # Write run summary
+    #------------------------------------------
+    num_done = sum(slide_info['status'] in ('done', 'skipped') for slide_info in lst_slide)
+    summary_file = f"image_patches.batch.{timestamp}.log"
+    with open(summary_file, 'w', encoding="utf-8") as fout:
+        fout.write("Logs: MRXS to image patches (batch)\n")
+        fout.write("[Summary]\n")
+        fout.write(f"Timestamp\t{timestamp}\n")
+        fout.write(f"input\t{args.mrxs_dir or args.mrxs_list}\n")
+        fout.write(f"outdir\t{args.outdir}\n")
+        fout.write(f"workers\t{args.workers}\n")
+        fout.write(f"num_slides\t{len(lst_slide)}\n")
+        fout.write(f"num_done\t{num_done}\n")
+        fout.write(f"num_skipped\t{sum(slide_info['status'] == 'skipped' for slide_info in lst_slide)}\n")
+        fout.write(f"num_failed\t{len(lst_slide) - num_done}\n")
+        fout.write(f"elapsed_sec\t{(datetime.now() - time_start).total_seconds():.1f}\n")
+        fout.write("\n[Slides]\n")
+        fout.write("\t".join(['mrxs', 'op', 'status', 'area_lv0', 'num_patches', 'num_tiled_patch', 'log_file', 'error']) + '\n')
+        for slide_info in lst_slide:
+            log_entries = slide_info.get('log_entries', {})
+            fout.write(f"{slide_info['mrxs']}\t{slide_info['op']}\t{slide_info['status']}\t{slide_info['area']}\t{log_entries.get('num_patches', '')}\t{slide_info.get('num_tiled_patch', '')}\t{slide_info.get('log_file', '')}\t{slide_info['error']}\n")
+    print(f"Batch: {num_done} of {len(lst_slide)} slides done, summary in {summary_file}")
+    if num_done < len(lst_slide):
+        sys.exit(1)
+
+def main(args):
+    #------------------------------------------
+    # Check inputs
+    #------------------------------------------
+    if args.mrxs and not args.op:
+        sys.exit("ERROR: --op is required with --mrxs!")
+    if not args.mrxs and args.op:
+        sys.exit("ERROR: --op is not used in batch mode, each slide is named after its MRXS file!")
+    try:
+        check_args(args)
+    except ValueError as e:
+        sys.exit(f"ERROR: {e}")
+
+    if not args.mrxs:
+        try:
+            tile_batch(args)
+        except (ValueError, FileNotFoundError) as e:
+            sys.exit(f"ERROR: {e}")
+        return
+
+    #------------------------------------------
+    # Main
+    #------------------------------------------
+    try:
+        timestamp, grid, log_entries = prepare_slide(args)
+    except ValueError as e:
+        sys.exit(f"ERROR: {e}")
+
+    # Tile the grid, either serially or in row bands across a process pool
+    time_start = time.perf_counter()
+    patch_stat = tile_row_bands(args, grid, timestamp)
+    patch_stat['time_tiling_sec'] = time.perf_counter() - time_start
+
+    #------------------------------------------
+    # Write log file
+    #------------------------------------------
+    write_slide_log(args, timestamp, log_entries, patch_stat)
+    remove_checkpoint(args)
 
 if __name__ == "__main__":
     # ~/anaconda3/envs/openslide/bin/python
     parser = argparse.ArgumentParser(description="Crop Whole Slide Image in image patches")
-    parser.add_argument("--mrxs", required=True)
-    parser.add_argument("--op", required=True)
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("--mrxs", help="Tile one slide")
+    input_group.add_argument("--mrxs_dir", help="Batch mode: tile every *.mrxs file in this folder, named after the file")
+    input_group.add_argument("--mrxs_list", help="Batch mode: tile the slides listed in this file, one path per line")
+    parser.add_argument("--op", help="Output name of the slide (required with --mrxs)")
     parser.add_argument("--patch_size", type=int, required=True, help="Image patch size (e.g. 1024px)")
     parser.add_argument("--output_image_format", required=True, choices=['JPEG', 'TIFF', 'PNG', 'JPEG-low'])
     parser.add_argument("--outdir", required=True, help="output directory should exist.")
+    parser.add_argument("--output_backend", default="files", choices=OUTPUT_BACKENDS, help="files: one image file per patch; tar: tar shards with an offset index per output folder, see extract_patches.py (default: files)")
+    parser.add_argument("--shard_size_mb", type=int, default=1024, help="Tar backend: start a new shard after this many MB (default: 1024)")
+    parser.add_argument("--roi", default="bounds", help="Region to tile: 'bounds' (scanned area from the MRXS bounds properties), 'full', 'x,y,width,height' in level 0 px, or a JSON file with x, y, width, height (default: bounds)")
+    parser.add_argument("--levels", type=parse_levels, default=[LEVEL_HIGHEST_RES], help="Comma-separated output levels, e.g. 0,1,2. Level L patches are patch_size/2^L px, downsampled in memory from the level 0 read (default: 0)")
+    parser.add_argument("--read_block_mb", type=float, default=64, help="Memory budget per tiling process for coalesced level 0 reads: adjacent patches are read one block at a time, blocks of up to half this size (the NumPy conversion briefly doubles a block), and cut in memory; 0 reads every patch on its own (default: 64)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes tiling row bands in parallel, shared by all slides in batch mode (default: 1, serial)")
+    parser.add_argument("--jpeg_encoder", default="pillow", choices=JPEG_ENCODERS, help="JPEG encoder: pillow, or turbojpeg (libjpeg-turbo through PyTurboJPEG, same quality settings; TIFF / PNG always use Pillow) (default: pillow)")
+    parser.add_argument("--encode_threads", type=int, default=2, help="Encoder threads per tiling process; 0 encodes on the reader thread (default: 2)")
+    parser.add_argument("--queue_depth", type=int, default=16, help="Max patches in flight between read and write per tiling process (default: 16)")
+    parser.add_argument("--resume", action="store_true", help="Resume an interrupted run in the existing output directory, redoing only patches not checkpointed as written")
+    parser.add_argument("--timings", action="store_true", help="Time every stage of every patch (read, queue wait, pad, downsample, convert, encode, write) and write per-stage totals and percentiles to the log")
+    parser.add_argument("--progress_sec", type=float, default=0, help="Print a progress line per tiling process at most every N seconds (default: 0, off)")
+    parser.add_argument("--tissue_threshold", default="otsu", help="Saturation threshold (0-255) for tissue pixels, or 'otsu' to derive it from the slide thumbnail (default: otsu)")
+    parser.add_argument("--min_tissue_fraction", type=float, default=0.0, help="Skip patches whose tissue fraction at the screening level is below this value (default: 0, keep all non-black patches)")
     #arguments = parser.parse_args('--mrxs /NetApp/users/deeplearn/Projects/marrow_morphology/raw_3dhistech/25H0340173-20x-EDF.mrxs --op haha --patch_size 1024 --output_image_format JPEG-low --outdir /NetApp/users/deeplearn/Projects/marrow_morphology/image_3dhistech/'.split())
     arguments = parser.parse_args()
     main(arguments)
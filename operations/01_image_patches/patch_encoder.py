@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import io
+from PIL import Image
+try:
+    # Optional libjpeg-turbo binding (pip install PyTurboJPEG)
+    from turbojpeg import TurboJPEG, TJPF_RGBX, TJSAMP_444, TJSAMP_420
+except ImportError:
+    TurboJPEG = None
+
+
+# In[ ]:
+
+
+JPEG_ENCODERS = ('pillow', 'turbojpeg')
+
+class PillowEncoder():
+    """
+    Encode RGBA patches (C-contiguous uint8 arrays of shape (height, width, 4)) with Pillow.
+    The array is wrapped without copy; for JPEG it is wrapped as RGBX, so the alpha channel is
+    dropped by the JPEG packer instead of a convert("RGB") copy. Output bytes are the same as
+    saving the RGBA image converted to RGB.
+    """
+    def encode(self, img_array, image_format):
+        """ Return the image bytes of img_array in image_format (JPEG, JPEG-low, TIFF or PNG) """
+        height, width = img_array.shape[:2]
+        buffer = io.BytesIO()
+        if image_format in ("JPEG", "JPEG-low"): #RGB
+            img = Image.frombuffer("RGBX", (width, height), img_array, "raw", "RGBX", 0, 1)
+            if image_format == "JPEG":
+                img.save(buffer, format='JPEG', quality=100, subsampling=0)
+            else:
+                img.save(buffer, format='JPEG')
+        elif image_format in ("TIFF", "PNG"): #RGBA
+            img = Image.frombuffer("RGBA", (width, height), img_array, "raw", "RGBA", 0, 1)
+            img.save(buffer, format=image_format)
+        else:
+            raise ValueError("Output format not supported.")
+        return buffer.getvalue()
+
+class TurboJpegEncoder(PillowEncoder):
+    """
+    Encode JPEG patches with libjpeg-turbo through PyTurboJPEG, reading the RGBA array as RGBX
+    directly. Same quality / chroma subsampling as the Pillow encoder (JPEG: quality 100, 4:4:4;
+    JPEG-low: Pillow defaults quality 75, 4:2:0), but the bytes may differ from Pillow's.
+    TIFF and PNG are encoded with Pillow.
+    """
+    def __init__(self):
+        if TurboJPEG is None:
+            raise ValueError("JPEG encoder turbojpeg needs PyTurboJPEG (pip install PyTurboJPEG) and libjpeg-turbo.")
+        try:
+            self.turbojpeg = TurboJPEG()
+        except OSError as e: # libjpeg-turbo shared library not found
+            raise ValueError(f"JPEG encoder turbojpeg cannot load libjpeg-turbo: {e}") from e
+
+    def encode(self, img_array, image_format):
+        if image_format == "JPEG":
+            return self.turbojpeg.encode(img_array, quality=100, pixel_format=TJPF_RGBX, jpeg_subsample=TJSAMP_444)
+        if image_format == "JPEG-low":
+            return self.turbojpeg.encode(img_array, quality=75, pixel_format=TJPF_RGBX, jpeg_subsample=TJSAMP_420)
+        return super().encode(img_array, image_format)
+
+def get_encoder(jpeg_encoder):
+    if jpeg_encoder == 'pillow':
+        return PillowEncoder()
+    elif jpeg_encoder == 'turbojpeg':
+        return TurboJpegEncoder()
+    raise ValueError(f"JPEG encoder {jpeg_encoder} not supported.")
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+# Patch manifest {op}.manifest.tsv, written by mrxs_to_image_patches.py in each output folder and read by
+# cvat_create_tasks.py: one row per grid cell of the ROI, in row/col order.
+# - image_name: relative to the output folder, '.' for black / background cells that are not written
+# - y_offset, x_offset: level 0 offset of the patch, as in its file name
+# - patch_size_y, patch_size_x: valid (unpadded) size of the patch in pixels of the folder's level
+MANIFEST_COLUMNS = {
+    'image_name': str,
+    'row': int,
+    'col': int,
+    'y_offset': int,
+    'x_offset': int,
+    'patch_size_y': int,
+    'patch_size_x': int,
+    'is_black': int,
+    'is_background': int,
+    'tissue_fraction': float,
+}
+
+def format_manifest_line(patch):
+    """ TSV line of a manifest row (dict with the MANIFEST_COLUMNS keys) """
+    return "\t".join(f"{patch[k]:.4f}" if column_type is float else str(column_type(patch[k])) for (k, column_type) in MANIFEST_COLUMNS.items()) + "\n"
+
+def parse_manifest_line(line, columns=tuple(MANIFEST_COLUMNS)):
+    """ Manifest row of a TSV line, typed according to MANIFEST_COLUMNS """
+    return {k: MANIFEST_COLUMNS[k](v) for (k, v) in zip(columns, line.rstrip("\n").split("\t"))}
+
+def read_manifest(manifest_file):
+    """ Yield the manifest rows as dicts typed according to MANIFEST_COLUMNS """
+    with open(manifest_file, 'r', encoding="utf-8") as fin:
+        columns = fin.readline().rstrip("\n").split("\t")
+        for line in fin:
+            yield parse_manifest_line(line, columns)
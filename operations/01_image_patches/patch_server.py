@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import argparse
+import json
+import os
+import queue
+import re
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote
+import numpy as np
+import openslide
+from mrxs_to_image_patches import LEVEL_HIGHEST_RES, get_grid, get_image_file_extension, get_image_name, get_manifest_file, get_manifest_patch, get_output_folder, get_patch_size, pad_patch, convert_patch
+from patch_encoder import JPEG_ENCODERS, get_encoder
+from patch_manifest import MANIFEST_COLUMNS, format_manifest_line
+
+
+# In[ ]:
+
+
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'tiff': 'image/tiff'}
+
+class SlideHandlePool():
+    """ A fixed number of OpenSlide handles of one slide, each used by one thread at a time """
+    def __init__(self, mrxs, num_handles):
+        self.handles = queue.Queue()
+        for _ in range(num_handles):
+            self.handles.put(openslide.OpenSlide(mrxs))
+
+    @contextmanager
+    def handle(self):
+        slide = self.handles.get()
+        try:
+            yield slide
+        finally:
+            self.handles.put(slide)
+
+    def close(self):
+        while not self.handles.empty():
+            self.handles.get().close()
+
+class PatchCache():
+    """
+    Size-bounded LRU cache of encoded patches, in memory and optionally in a disk folder.
+    A disk hit is promoted to memory; entries evicted from memory stay on disk until the disk
+    budget evicts them too. Files already in the disk folder are reused, oldest first to evict.
+    """
+    def __init__(self, memory_bytes, disk_folder=None, disk_bytes=0):
+        self.lock = threading.Lock()
+        self.memory = OrderedDict() # image_name -> bytes, least recently used first
+        self.memory_bytes = memory_bytes
+        self.memory_used = 0
+        self.disk = OrderedDict() # image_name -> file size, least recently used first
+        self.disk_folder = Path(disk_folder) if disk_folder else None
+        self.disk_bytes = disk_bytes
+        self.disk_used = 0
+        self.stat = {'hit_memory': 0, 'hit_disk': 0, 'miss': 0}
+        if self.disk_folder:
+            self.disk_folder.mkdir(parents=True, exist_ok=True)
+            entries = [entry for entry in os.scandir(self.disk_folder) if entry.is_file() and not entry.name.endswith(".tmp")]
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                self.disk[entry.name] = entry.stat().st_size
+                self.disk_used += entry.stat().st_size
+            self._evict()
+
+    def get(self, image_name):
+        """ Return the cached bytes or None """
+        with self.lock:
+            if image_name in self.memory:
+                self.memory.move_to_end(image_name)
+                self.stat['hit_memory'] += 1
+                return self.memory[image_name]
+            on_disk = image_name in self.disk
+            if on_disk:
+                self.disk.move_to_end(image_name)
+        if on_disk:
+            try:
+                with open(self.disk_folder / image_name, 'rb') as fin:
+                    data = fin.read()
+            except FileNotFoundError: # Evicted meanwhile
+                data = None
+            if data is not None:
+                os.utime(self.disk_folder / image_name) # Recency survives a restart
+                self._put_memory(image_name, data)
+                with self.lock:
+                    self.stat['hit_disk'] += 1
+                return data
+        with self.lock:
+            self.stat['miss'] += 1
+        return None
+
+    def put(self, image_name, data):
+        self._put_memory(image_name, data)
+        if self.disk_folder and len(data) <= self.disk_bytes:
+            tmp_file = self.disk_folder / f"{image_name}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'wb') as fout:
+                fout.write(data)
+            os.replace(tmp_file, self.disk_folder / image_name)
+            with self.lock:
+                self.disk_used += len(data) - self.disk.pop(image_name, 0)
+                self.disk[image_name] = len(data)
+                self._evict()
+
+    def _put_memory(self, image_name, data):
+        if len(data) > self.memory_bytes:
+            return
+        with self.lock:
+            if image_name not in self.memory:
+                self.memory[image_name] = data
+                self.memory_used += len(data)
+            self.memory.move_to_end(image_name)
+            self._evict()
+
+    def _evict(self):
+        """ Drop least recently used entries over the budgets; call with the lock held (or from __init__) """
+        while self.memory_used > self.memory_bytes:
+            _, data = self.memory.popitem(last=False)
+            self.memory_used -= len(data)
+        while self.disk_folder and self.disk_used > self.disk_bytes:
+            image_name, num_bytes = self.disk.popitem(last=False)
+            self.disk_used -= num_bytes
+            try:
+                os.remove(self.disk_folder / image_name)
+            except FileNotFoundError:
+                pass
+
+class PatchRenderer():
+    """
+    Render the level 0 patches of the mrxs_to_image_patches.py grid of a slide on demand.
+    The grid is built and screened as by the tiler (same --roi, tissue options), and only cells
+    the tiler would write (non-black, enough tissue, within the ROI) are rendered; a rendered
+    patch has the tiler's name and bytes. Concurrent requests for the same patch render it once.
+    """
+    def __init__(self, args, cache=None):
+        self.args = args
+        self.cache = cache
+        self.handles = SlideHandlePool(args.mrxs, args.handles)
+        with self.handles.handle() as slide:
+            self.grid = get_grid(args, slide)
+        self.encoder = get_encoder(args.jpeg_encoder)
+        self.ext = get_image_file_extension(args.output_image_format)
+        self.name_pattern = re.compile(rf"^{re.escape(args.op)}\.(\d+)_(\d+)\.(\d+)_(\d+)\.{self.ext}$")
+        self.lock = threading.Lock()
+        self.in_flight = {} # image_name -> threading.Event set once rendered
+
+    def close(self):
+        self.handles.close()
+
+    def get_cell(self, image_name):
+        """ (row_idx, col_idx) of a patch name of the grid, or None if the name is not a patch the tiler would write """
+        match = self.name_pattern.match(image_name)
+        if not match:
+            return None
+        row_idx, col_idx = int(match.group(1)), int(match.group(2))
+        (row_start, row_end), (col_start, col_end) = self.grid['row_range'], self.grid['col_range']
+        if not (row_start <= row_idx < row_end and col_start <= col_idx < col_end and self.grid['mask'][row_idx, col_idx]):
+            return None
+        if self.get_image_name(row_idx, col_idx) != image_name: # Offsets and zero-padding must match too
+            return None
+        return row_idx, col_idx
+
+    def get_image_name(self, row_idx, col_idx):
+        y, x = row_idx * self.args.patch_size, col_idx * self.args.patch_size
+        return os.path.basename(get_image_name(self.args, self.grid, row_idx, col_idx, y, x, LEVEL_HIGHEST_RES))
+
+    def render(self, row_idx, col_idx):
+        """ Read, pad and encode one patch as the tiler does. Return the image bytes. """
+        y, x = row_idx * self.args.patch_size, col_idx * self.args.patch_size
+        patch_size_y, patch_size_x = get_patch_size(self.args, self.grid, y, x)
+        with self.handles.handle() as slide:
+            img_array = np.asarray(slide.read_region((x, y), LEVEL_HIGHEST_RES, (patch_size_x, patch_size_y)))
+        return self.encoder.encode(convert_patch(pad_patch(self.args, img_array)), self.args.output_image_format)
+
+    def get_patch(self, image_name):
+        """ Return the image bytes of a patch name, from the cache or rendered; None if it is not a patch of the grid """
+        cell = self.get_cell(image_name)
+        if cell is None:
+            return None
+        if self.cache is None:
+            return self.render(*cell)
+        while True:
+            data = self.cache.get(image_name)
+            if data is not None:
+                return data
+            with self.lock:
+                event = self.in_flight.get(image_name)
+                if event is None:
+                    self.in_flight[image_name] = threading.Event()
+                    break
+            event.wait() # Rendered by another request, then served from the cache
+        try:
+            data = self.render(*cell)
+            self.cache.put(image_name, data)
+            return data
+        finally:
+            with self.lock:
+                self.in_flight.pop(image_name).set()
+
+def make_request_handler(renderer):
+    class PatchRequestHandler(BaseHTTPRequestHandler):
+        """
+        GET /             slide, grid and cache statistics as JSON
+        GET /<patch name> patch image, 404 if the name is not a patch the tiler would write
+        Rendering errors are answered 400 (ValueError), 404 (KeyError) or 500 (any other error, e.g. OpenSlide, PIL or IO)
+        instead of dropping the connection.
+        """
+        def do_GET(self):
+            image_name = unquote(self.path.split("?")[0].lstrip("/"))
+            if image_name == "":
+                self._send(200, "application/json", json.dumps(get_server_info(renderer), indent=2).encode("utf-8"))
+                return
+            try:
+                data = renderer.get_patch(image_name)
+            except ValueError as e:
+                self._send(400, "text/plain", f"{image_name}: {e}\n".encode("utf-8"))
+                return
+            except KeyError as e:
+                self._send(404, "text/plain", f"{image_name}: {e}\n".encode("utf-8"))
+                return
+            except Exception as e:
+                self.log_error("Rendering %s failed: %s: %s", image_name, type(e).__name__, e)
+                self._send(500, "text/plain", f"{image_name}: {type(e).__name__}: {e}\n".encode("utf-8"))
+                return
+            if data is None:
+                self._send(404, "text/plain", f"{image_name} is not a patch of {renderer.args.op}\n".encode("utf-8"))
+                return
+            self._send(200, CONTENT_TYPES[renderer.ext], data)
+
+        def _send(self, status, content_type, data):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    return PatchRequestHandler
+
+def get_server_info(renderer):
+    grid = renderer.grid
+    return {
+        'mrxs': renderer.args.mrxs,
+        'op': renderer.args.op,
+        'patch_size': renderer.args.patch_size,
+        'output_image_format': renderer.args.output_image_format,
+        'slide_dimensions': grid['slide_dimensions'],
+        'roi_lv0': grid['roi'],
+        'num_row': grid['num_row'],
+        'num_column': grid['num_column'],
+        'row_range': grid['row_range'],
+        'col_range': grid['col_range'],
+        'num_patches': int(grid['mask'].sum()),
+        'cache': dict(renderer.cache.stat) if renderer.cache else None,
+    }
+
+def select_image_names(renderer, args):
+    """ Patch names to materialize: from --task_json (optionally --tasks), --patch_list and / or --rows / --cols """
+    grid = renderer.grid
+    selected = np.zeros_like(grid['mask'])
+    ranges = [] # (row_start, row_end, col_start, col_end), inclusive
+    if args.task_json:
+        task_config = json.load(open(args.task_json, 'r', encoding="utf-8"))
+        task_names = args.tasks.split(",") if args.tasks else None
+        for task in task_config['tasks']:
+            if task_names is None or task['name'] in task_names:
+                rows, cols = task.get('rows') or [0, grid['num_row'] - 1], task.get('cols') or [0, grid['num_column'] - 1]
+                ranges.append((rows[0], rows[1], cols[0], cols[1]))
+    if args.rows or args.cols:
+        rows, cols = args.rows or [0, grid['num_row'] - 1], args.cols or [0, grid['num_column'] - 1]
+        ranges.append((rows[0], rows[1], cols[0], cols[1]))
+    for (row_start, row_end, col_start, col_end) in ranges:
+        selected[row_start:row_end + 1, col_start:col_end + 1] = True
+    selected &= grid['mask']
+    image_names = [renderer.get_image_name(row_idx, col_idx) for (row_idx, col_idx) in zip(*np.nonzero(selected))]
+
+    if args.patch_list:
+        with open(args.patch_list, 'r', encoding="utf-8") as fin:
+            wanted = [os.path.basename(line.strip()) for line in fin if line.strip()]
+        unknown = [name for name in wanted if renderer.get_cell(name) is None]
+        if unknown:
+            print(f"WARNING: {len(unknown)} patches in {args.patch_list} are not patches of {args.op}, e.g. {unknown[0]}")
+        image_names = sorted(set(image_names) | (set(wanted) - set(unknown)))
+    return image_names
+
+def get_renderer(args, cache=None):
+    if not Path(args.mrxs).exists():
+        sys.exit(f"ERROR: Input MRSX file [{args.mrxs}] does not exist!")
+    if args.tissue_threshold != "otsu" and not (args.tissue_threshold.isdigit() and 0 <= int(args.tissue_threshold) <= 255):
+        sys.exit(f"ERROR: --tissue_threshold must be 'otsu' or an integer in 0-255 (got {args.tissue_threshold})!")
+    try:
+        return PatchRenderer(args, cache)
+    except ValueError as e:
+        sys.exit(f"ERROR: {e}")
+
+def serve(args):
+    cache = PatchCache(int(args.cache_mb * 1024 ** 2), args.disk_cache, int(args.disk_cache_mb * 1024 ** 2))
+    renderer = get_renderer(args, cache)
+    server = ThreadingHTTPServer((args.host, args.port), make_request_handler(renderer))
+    print(f"Serving {int(renderer.grid['mask'].sum())} patches of {args.mrxs} as {args.op}.<row>_<col>.<y>_<x>.{renderer.ext} on http://{args.host}:{server.server_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        renderer.close()
+
+def write_manifest(renderer, output_folder):
+    """
+    Write {op}.manifest.tsv to the output folder as the tiler does, so cvat_create_tasks.py groups the patches from it:
+    every cell of the ROI in row/col order, named if its patch is in the folder (materialized now or before), '.' otherwise.
+    """
+    grid = renderer.grid
+    image_names = set(os.listdir(output_folder))
+    manifest_file = get_manifest_file(renderer.args)
+    tmp_file = output_folder / f".{manifest_file.name}.tmp"
+    with open(tmp_file, 'w', encoding="utf-8") as fout:
+        fout.write("\t".join(MANIFEST_COLUMNS) + "\n")
+        for row_idx in range(*grid['row_range']):
+            for col_idx in range(*grid['col_range']):
+                image_name = renderer.get_image_name(row_idx, col_idx) if grid['mask'][row_idx, col_idx] else '.'
+                if image_name not in image_names:
+                    image_name = '.'
+                fout.write(format_manifest_line(get_manifest_patch(renderer.args, grid, row_idx, col_idx, image_name)))
+    os.replace(tmp_file, manifest_file)
+    return manifest_file
+
+def materialize(args):
+    """ Write the selected patches to {outdir}/{op}/ as the tiler would, skipping patches already there, and the folder's manifest """
+    if not (args.task_json or args.patch_list or args.rows or args.cols):
+        sys.exit("ERROR: Select patches with --task_json, --patch_list and / or --rows / --cols!")
+    if not Path(args.outdir).is_dir():
+        sys.exit(f"ERROR: Output folder [{args.outdir}] does not exist!")
+    renderer = get_renderer(args)
+    output_folder = get_output_folder(args)
+    output_folder.mkdir(exist_ok=True)
+    image_names = select_image_names(renderer, args)
+
+    def write(image_name):
+        """ Write one patch; return 'written' or 'skipped' (already materialized) """
+        output_file = output_folder / image_name
+        if output_file.exists():
+            return 'skipped'
+        data = renderer.get_patch(image_name)
+        tmp_file = output_folder / f".{image_name}.tmp"
+        with open(tmp_file, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp_file, output_file) # A patch file is complete once it has its name
+        return 'written'
+
+    with ThreadPoolExecutor(max_workers=args.handles) as executor:
+        lst_status = list(executor.map(write, image_names))
+    manifest_file = write_manifest(renderer, output_folder)
+    renderer.close()
+    print(f"Selected {len(image_names)} patches -> {output_folder}: {lst_status.count('written')} written, {lst_status.count('skipped')} already present. Manifest: {manifest_file}")
+
+if __name__ == "__main__":
+    # ~/anaconda3/envs/openslide/bin/python
+    parser = argparse.ArgumentParser(description="Serve or materialize the image patches of mrxs_to_image_patches.py on demand, without tiling the whole slide")
+    # Grid options, as for mrxs_to_image_patches.py
+    parser.add_argument("--mrxs", required=True)
+    parser.add_argument("--op", required=True)
+    parser.add_argument("--patch_size", type=int, required=True, help="Image patch size (e.g. 1024px)")
+    parser.add_argument("--output_image_format", required=True, choices=['JPEG', 'TIFF', 'PNG', 'JPEG-low'])
+    parser.add_argument("--roi", default="bounds", help="Region of the grid, as for mrxs_to_image_patches.py (default: bounds)")
+    parser.add_argument("--tissue_threshold", default="otsu", help="As for mrxs_to_image_patches.py (default: otsu)")
+    parser.add_argument("--min_tissue_fraction", type=float, default=0.0, help="As for mrxs_to_image_patches.py (default: 0)")
+    parser.add_argument("--jpeg_encoder", default="pillow", choices=JPEG_ENCODERS)
+    parser.add_argument("--handles", type=int, default=8, help="Number of OpenSlide handles / rendering threads (default: 8)")
+    subparser = parser.add_subparsers(dest="command", required=True)
+    # HTTP server
+    parser_serve = subparser.add_parser("serve", help="Serve patches over HTTP at /<patch name>")
+    parser_serve.add_argument("--host", default="127.0.0.1")
+    parser_serve.add_argument("--port", type=int, default=8080)
+    parser_serve.add_argument("--cache_mb", type=float, default=512, help="In-memory LRU cache of encoded patches (default: 512)")
+    parser_serve.add_argument("--disk_cache", help="Folder of the on-disk LRU cache (default: no disk cache)")
+    parser_serve.add_argument("--disk_cache_mb", type=float, default=10240, help="On-disk LRU cache size (default: 10240)")
+    # Materialize
+    parser_materialize = subparser.add_parser("materialize", help="Write selected patches to <outdir>/<op>/ as the tiler would")
+    parser_materialize.add_argument("--outdir", required=True, help="output directory should exist.")
+    parser_materialize.add_argument("--task_json", help="Task JSON of cvat_create_tasks.py: materialize the rows / cols of its tasks")
+    parser_materialize.add_argument("--tasks", help="Comma-separated task names of --task_json (default: all tasks)")
+    parser_materialize.add_argument("--patch_list", help="File with one patch name per line (basename or path)")
+    parser_materialize.add_argument("--rows", type=int, nargs=2, metavar=("ROW_START", "ROW_END"), help="Inclusive row range")
+    parser_materialize.add_argument("--cols", type=int, nargs=2, metavar=("COL_START", "COL_END"), help="Inclusive column range")
+    arguments = parser.parse_args()
+    arguments.outdir = getattr(arguments, 'outdir', ".")
+    arguments.levels = [LEVEL_HIGHEST_RES]
+    if arguments.command == "serve":
+        serve(arguments)
+    else:
+        materialize(arguments)
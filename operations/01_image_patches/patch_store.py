@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import io
+import math
+import os
+import tarfile
+import threading
+import time
+from pathlib import Path
+
+
+# In[ ]:
+
+
+OUTPUT_BACKENDS = ('files', 'tar')
+INDEX_COLUMNS = ['image_name', 'shard', 'offset', 'size']
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.tiff') # Patch files, other files of an output folder (e.g. the manifest) are not patches
+
+class FilePatchStore():
+    """ Write each patch as its own image file (default backend) """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def write(self, image_name, data):
+        with open(self.folder / image_name, 'wb') as fout:
+            fout.write(data)
+
+    def close(self):
+        pass
+
+class TarPatchStore():
+    """
+    Append patches to tar shards in one folder instead of writing one file per patch.
+    - shards: {folder}/{prefix}.{shard_idx:04d}.tar, a new shard is started once shard_size bytes are reached
+    - index:  {folder}/{prefix}.index.tsv with columns image_name, shard, offset, size
+              (offset / size of the image bytes inside the shard, for O(1) random access)
+    The index line is appended and flushed after the patch bytes, so a shard cut short
+    by an interruption still has a valid index for every patch it lists.
+    """
+    def __init__(self, folder, prefix, shard_size):
+        self.folder = Path(folder)
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shard_idx = -1
+        self.shard_file = None
+        self.shard_tar = None
+        self.index = open(self.folder / f"{prefix}.index.tsv", 'a', encoding="utf-8")
+
+    def write(self, image_name, data):
+        if (self.shard_tar is None) or (self.shard_file.tell() >= self.shard_size):
+            self._open_next_shard()
+        tarinfo = tarfile.TarInfo(image_name)
+        tarinfo.size = len(data)
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0o644
+        self.shard_tar.addfile(tarinfo, io.BytesIO(data))
+        self.shard_file.flush()
+        # Image bytes end where the tar offset stands, minus the padding to 512-byte blocks
+        offset_data = self.shard_tar.offset - math.ceil(tarinfo.size / tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.index.write(f"{image_name}\t{os.path.basename(self.shard_file.name)}\t{offset_data}\t{tarinfo.size}\n")
+        self.index.flush()
+
+    def close(self):
+        self._close_shard()
+        self.index.close()
+
+    def _open_next_shard(self):
+        self._close_shard()
+        self.shard_idx += 1
+        self.shard_file = open(self.folder / f"{self.prefix}.{self.shard_idx:04d}.tar", 'wb')
+        self.shard_tar = tarfile.open(fileobj=self.shard_file, mode='w', format=tarfile.PAX_FORMAT)
+
+    def _close_shard(self):
+        if self.shard_tar is not None:
+            self.shard_tar.close()
+            self.shard_file.close()
+            self.shard_tar = None
+
+class FilePatchStoreReader():
+    """ Read patches written by FilePatchStore """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def get_image_names(self):
+        return sorted(entry.name for entry in os.scandir(self.folder) if entry.is_file() and entry.name.endswith(IMAGE_EXTENSIONS) and not entry.name.startswith("."))
+
+    def read(self, image_name):
+        """ Return the image bytes, or None if the patch is missing """
+        try:
+            with open(self.folder / image_name, 'rb') as fin:
+                return fin.read()
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        pass
+
+class TarPatchStoreReader():
+    """
+    Random access to the patches of all tar shards in a folder, through their index files.
+    Index files are loaded in name order; if a patch was written more than once (e.g. by a
+    resumed run), the last entry wins. Reads use os.pread and are safe across threads.
+    """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.index = {} # image_name -> (shard, offset, size)
+        self.shard_fds = {} # shard -> file descriptor
+        self.lock = threading.Lock()
+        for index_file in sorted(self.folder.glob("*.index.tsv")):
+            with open(index_file, 'r', encoding="utf-8") as fin:
+                for line in fin:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != len(INDEX_COLUMNS) or not (fields[2].isdigit() and fields[3].isdigit()):
+                        continue # Line torn by an interruption
+                    self.index[fields[0]] = (fields[1], int(fields[2]), int(fields[3]))
+
+    def get_image_names(self):
+        return sorted(self.index)
+
+    def read(self, image_name):
+        """ Return the image bytes, or None if the patch, its shard or part of the shard is missing """
+        if image_name not in self.index:
+            return None
+        shard, offset, size = self.index[image_name]
+        with self.lock:
+            if shard not in self.shard_fds:
+                try:
+                    self.shard_fds[shard] = os.open(self.folder / shard, os.O_RDONLY)
+                except FileNotFoundError:
+                    return None
+        data = os.pread(self.shard_fds[shard], size, offset)
+        return data if len(data) == size else None
+
+    def close(self):
+        for fd in self.shard_fds.values():
+            os.close(fd)
+        self.shard_fds = {}
+
+def open_patch_store(backend, folder, prefix, shard_size):
+    if backend == 'files':
+        return FilePatchStore(folder)
+    elif backend == 'tar':
+        return TarPatchStore(folder, prefix, shard_size)
+    raise ValueError(f"Output backend {backend} not supported.")
+
+def open_patch_store_reader(backend, folder):
+    if backend == 'files':
+        return FilePatchStoreReader(folder)
+    elif backend == 'tar':
+        return TarPatchStoreReader(folder)
+    raise ValueError(f"Output backend {backend} not supported.")
@@ -5,19 +5,49 @@
 
 
 import argparse
-import glob
+import bisect
 import os
 import re
 import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import urllib3
+from PIL import Image
 from cvat_sdk import make_client
 from cvat_sdk.api_client import models
+from cvat_sdk.api_client.exceptions import ApiException
 from cvat_sdk.core.proxies.tasks import ResourceType
+# Patch manifest format, shared with mrxs_to_image_patches.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "01_image_patches"))
+from patch_manifest import read_manifest
 
 
 # In[ ]:
 
 
+# Patch file name written by mrxs_to_image_patches.py: {op}.{row}_{col}.{y_offset}_{x_offset}.{ext}
+PATCH_NAME_PATTERN = re.compile(r'(\S+)\.(\d+)_(\d+)\.(\d+)_(\d+)', re.IGNORECASE) # 25H0340173.148_021.151552_21504.jpg
+
+# Folder of the CVAT dataset manifests (manifest.jsonl) of the tasks, in the image folder
+CVAT_MANIFEST_FOLDER = "cvat_manifests"
+
+# HTTP status of CVAT API errors worth retrying (timeouts, rate limiting, server overload / restarts)
+TRANSIENT_HTTP_STATUS = (408, 429, 500, 502, 503, 504)
+
+def find_manifest_file(cvat_share_path, image_folder):
+    """
+    The patch manifest written by mrxs_to_image_patches.py in an image folder: its only *.manifest.tsv
+    ({op}.manifest.tsv, also in the {op}.lv{L} folders of --levels), None if there is none.
+    """
+    image_folder_path = os.path.join(cvat_share_path, image_folder)
+    with os.scandir(image_folder_path) as entries:
+        manifest_names = sorted(entry.name for entry in entries if entry.name.endswith(".manifest.tsv") and entry.is_file())
+    if len(manifest_names) > 1:
+        raise ValueError(f"ERROR: Several manifests in [{image_folder_path}] ({', '.join(manifest_names)}), choose one with --manifest.")
+    return os.path.join(image_folder_path, manifest_names[0]) if manifest_names else None
+
 class ImagePatchGrouper():
     def __init__(self, cvat_share_path, image_folder, image_extension):
         assert image_extension in ('jpg', 'png', 'tiff')
@@ -29,14 +59,39 @@ class ImagePatchGrouper():
         self.patch_data = []  # List of (row, col, filepath) tuples
         self.grid_rows = 0 # No. of rows detected
         self.grid_cols = 0 # No. of columns detected
+        self.grid_index = {} # row -> ([col, ...], [patch_path, ...]) sorted by column
         self.task_patches = {} # task_name -> list of image patches
         self.task_regions = {} # task_name -> {row: (row_start, row_end), col: (col_start, col_end)}
 
 
+    def load_manifest(self, manifest_file):
+        """
+        Load image patches and row / column index from the patch manifest written by mrxs_to_image_patches.py
+        ({op}.manifest.tsv in the image folder, see find_manifest_file; one row per grid cell of the tiled ROI). The grid
+        dimensions are taken from the last row / column of the ROI, including black / background cells without an image file.
+        """
+        self.patch_data = []
+        rows = set()
+        cols = set()
+        for patch in read_manifest(manifest_file):
+            rows.add(patch['row'])
+            cols.add(patch['col'])
+            if patch['image_name'] == '.' or not patch['image_name'].endswith(f".{self.image_extension}"):
+                continue
+            image_file = os.path.join(self.cvat_share_path, self.image_folder, patch['image_name'])
+            self.patch_data.append((patch['row'], patch['col'], os.path.relpath(image_file, self.cvat_share_path)))
+        self.patch_data.sort(key=lambda patch: patch[2]) # Same order as the sorted folder listing in load_patches()
+        self.patches = [patch_path for (_, _, patch_path) in self.patch_data]
+        print(f"Loaded manifest: {manifest_file}")
+        self._build_grid_index(max(rows) + 1, max(cols) + 1)
+
     def load_patches(self):
-        """ Load all image patches and extract row / column index from filename """
-        for image_file in sorted(glob.glob(os.path.join(self.cvat_share_path, self.image_folder, f"*.{self.image_extension}"))):
-            self.patches.append(image_file.replace(self.cvat_share_path, ""))
+        """ Load all image patches with one scandir of the image folder and extract row / column index from filename """
+        image_folder_path = os.path.join(self.cvat_share_path, self.image_folder)
+        with os.scandir(image_folder_path) as entries:
+            image_names = [entry.name for entry in entries if entry.name.endswith(f".{self.image_extension}") and not entry.name.startswith('.')]
+        for image_name in sorted(image_names):
+            self.patches.append(os.path.relpath(os.path.join(image_folder_path, image_name), self.cvat_share_path))
         self._extract_patch_coordinates()
 
     def _extract_patch_coordinates(self):
@@ -49,26 +104,46 @@ class ImagePatchGrouper():
             if coords:
                 row, col, _, _ = coords
                 self.patch_data.append((row, col, patch_path))
+        self._build_grid_index()
+
+    def _build_grid_index(self, grid_rows=None, grid_cols=None):
+        """
+        Index patch_data by row, then column, so a task rectangle is answered by looking up its rows
+        and bisecting its columns instead of scanning every patch.
+        The grid dimensions are given by the manifest (last row / column of the ROI), else taken from the last indexed row / column.
+        """
+        self.grid_index = {}
+        for row, col, patch_path in sorted(self.patch_data, key=lambda patch: (patch[0], patch[1])):
+            row_cols, row_paths = self.grid_index.setdefault(row, ([], []))
+            row_cols.append(col)
+            row_paths.append(patch_path)
+        self.grid_rows = grid_rows if grid_rows is not None else max(self.grid_index) + 1
+        self.grid_cols = grid_cols if grid_cols is not None else max(row_cols[-1] for (row_cols, _) in self.grid_index.values()) + 1
 
-        # Get grid dimensions
-        rows = set(row for row, col, path in self.patch_data)
-        cols = set(col for row, col, path in self.patch_data)
-        
-        self.grid_rows = max(rows) + 1
-        self.grid_cols = max(cols) + 1
-        
         print(f"Detected grid: {self.grid_rows} rows x {self.grid_cols} columns")
         print(f"Row range: 0 - {self.grid_rows - 1}")
         print(f"Column range: 0 - {self.grid_cols - 1}")
 
+    def get_region_patches(self, start_row, end_row, start_col, end_col):
+        """ Image patches within rows start_row-end_row and columns start_col-end_col (inclusive), in row / column order """
+        region_patches = []
+        for row in range(start_row, end_row + 1):
+            if row in self.grid_index:
+                row_cols, row_paths = self.grid_index[row]
+                region_patches.extend(row_paths[bisect.bisect_left(row_cols, start_col):bisect.bisect_right(row_cols, end_col)])
+        return region_patches
+
+    def get_row_patch_counts(self):
+        """ Number of image patches of every grid row """
+        return [len(self.grid_index[row][0]) if row in self.grid_index else 0 for row in range(self.grid_rows)]
+
     def _parse_coordinates_from_filename(self, filename):
         """
         Parse row and column coordinates from filename
         Naming pattern: patch.row_col.yoffset_xoffset.ext
         """
         filename_without_ext = os.path.splitext(filename)[0]
-        pattern = r'(\S+)\.(\d+)_(\d+)\.(\d+)_(\d+)' # 25H0340173.148_021.151552_21504.jpg
-        match = re.search(pattern, filename_without_ext, re.IGNORECASE)
+        match = PATCH_NAME_PATTERN.search(filename_without_ext)
         if match:
             row = int(match.group(2))
             col = int(match.group(3))
@@ -138,17 +213,310 @@ class ImagePatchGrouper():
             raise ValueError(f"ERROR: Task '{task_name}' has invalid column range [{start_col}, {end_col}]")
         
         # Find the image patches within the row and column ranges
-        task_patches = []
-        for row, col, patch_path in self.patch_data:
-            if (start_row <= row <= end_row) and (start_col <= col <= end_col):
-                task_patches.append(patch_path)
+        task_patches = self.get_region_patches(start_row, end_row, start_col, end_col)
         print(f"Task '{task_name}': Rows {start_row}-{end_row}, Cols {start_col}-{end_col} -> {len(task_patches)} patches")
         self.task_patches[task_name] = task_patches
         self.task_regions[task_name] = {'row':(start_row, end_row), 'col':(start_col, end_col)}
     
     def get_task_patches(self, task_name):
         return self.task_patches[task_name]
-    
+
+def get_task_layout(grouper, frames_per_task):
+    """
+    Task config splitting the grid into bands of whole rows of about frames_per_task image patches:
+    a band is closed before the row that would take it over frames_per_task (a single row larger than
+    frames_per_task gets its own task). Rows without patches are kept in the next band, and a last
+    band without patches is merged into the previous one. Tasks are named R00, R01, ... as in tasks.50rows.json.
+    """
+    if frames_per_task <= 0:
+        raise ValueError(f"ERROR: Frames per task must be positive, got {frames_per_task}.")
+    bands = [] # [row_start, row_end, patch count]
+    band = None
+    for row, num_patches in enumerate(grouper.get_row_patch_counts()):
+        if band is not None and band[2] > 0 and band[2] + num_patches > frames_per_task:
+            bands.append(band)
+            band = None
+        if band is None:
+            band = [row, row, 0]
+        band[1] = row
+        band[2] += num_patches
+    if band is not None:
+        if band[2] == 0 and bands:
+            bands[-1][1] = band[1]
+        else:
+            bands.append(band)
+
+    name_width = max(2, len(str(len(bands) - 1)))
+    tasks = [{'name': f"R{i:0{name_width}d}", 'description': f"Row {row_start}-{row_end}", 'rows': [row_start, row_end]}
+             for (i, (row_start, row_end, _)) in enumerate(bands)]
+    return {'description': f"Group images for about {frames_per_task} frames per task", 'tasks': tasks}
+
+def get_image_size(image_file):
+    """ (width, height) read from the image header, without decoding the image """
+    with Image.open(image_file) as img:
+        return img.size
+
+def write_cvat_manifest(manifest_file, patch_paths, image_sizes):
+    """
+    Write the CVAT dataset manifest (manifest.jsonl, version 1.1) of a task: one line per image with its
+    name relative to the CVAT share, extension, width and height, in lexicographical order.
+    """
+    with open(manifest_file, 'w', encoding="utf-8") as fout:
+        fout.write(json.dumps({'version': '1.1'}) + "\n")
+        fout.write(json.dumps({'type': 'images'}) + "\n")
+        for patch_path in sorted(patch_paths):
+            name, extension = os.path.splitext(patch_path)
+            width, height = image_sizes[patch_path]
+            fout.write(json.dumps({'name': name, 'extension': extension, 'width': width, 'height': height}) + "\n")
+
+def write_cvat_manifests(grouper, task_names, task_prefix, patch_size, threads):
+    """
+    Write the CVAT manifest of every task in task_names to {image_folder}/cvat_manifests/{task_prefix}_{name}.manifest.jsonl,
+    so the server does not open every image of the share to get its size.
+    Image sizes are patch_size x patch_size if given (tiler patches are all padded to the patch size),
+    else read from the image headers with `threads` threads.
+    Return task name -> manifest path relative to the CVAT share.
+    """
+    patch_paths = sorted(set(patch_path for task_name in task_names for patch_path in grouper.get_task_patches(task_name)))
+    if patch_size:
+        image_sizes = {patch_path: (patch_size, patch_size) for patch_path in patch_paths}
+    else:
+        image_files = [os.path.join(grouper.cvat_share_path, patch_path) for patch_path in patch_paths]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            image_sizes = dict(zip(patch_paths, executor.map(get_image_size, image_files)))
+
+    manifest_folder = os.path.join(grouper.cvat_share_path, grouper.image_folder, CVAT_MANIFEST_FOLDER)
+    os.makedirs(manifest_folder, exist_ok=True)
+    task_manifests = {}
+    for task_name in task_names:
+        manifest_file = os.path.join(manifest_folder, f"{task_prefix}_{task_name}.manifest.jsonl")
+        write_cvat_manifest(manifest_file, grouper.get_task_patches(task_name), image_sizes)
+        task_manifests[task_name] = os.path.relpath(manifest_file, grouper.cvat_share_path)
+    print(f"Wrote CVAT manifests of {len(task_names)} tasks ({len(patch_paths)} images) to {manifest_folder}")
+    return task_manifests
+
+def is_transient_error(e):
+    """ Connection errors, timeouts and TRANSIENT_HTTP_STATUS responses """
+    if isinstance(e, ApiException):
+        return e.status in TRANSIENT_HTTP_STATUS
+    return isinstance(e, (urllib3.exceptions.HTTPError, ConnectionError, TimeoutError))
+
+def get_project_tasks_by_name(project):
+    """ Existing tasks of the project, listed once (page by page), by task name """
+    tasks_by_name = {}
+    for task in project.get_tasks():
+        tasks_by_name.setdefault(task.name, []).append(task)
+    return tasks_by_name
+
+def get_task_status(existing_tasks, expected_frame_count):
+    """
+    What to do with a task given the existing tasks of the same name:
+    ('skipped', task) if one of them has the expected frame count, i.e. its data was fully processed (the oldest one if several);
+    ('recreated', None) if they are all partially created, to be removed and created again; ('created', None) if there is none.
+    """
+    complete_tasks = sorted((task for task in existing_tasks if task.size == expected_frame_count), key=lambda task: task.id)
+    if complete_tasks:
+        return 'skipped', complete_tasks[0]
+    return ('recreated' if existing_tasks else 'created'), None
+
+def remove_tasks_by_name(client, project_id, task_name):
+    """ Remove the tasks of the project named task_name, looked up on the server page by page. Return their IDs. """
+    task_ids = []
+    page = 1
+    while True:
+        (data, response) = client.api_client.tasks_api.list(project_id=project_id, name=task_name, page=page, page_size=100)
+        task_ids.extend(task.id for task in data.results if task.name == task_name) # The name filter also matches longer names
+        if not data.next:
+            break
+        page += 1
+    if task_ids:
+        client.tasks.remove_by_ids(task_ids)
+    return task_ids
+
+def remove_failed_task(client, task_spec):
+    """
+    Remove what failed attempts left of a task on the server, including a task whose create() timed out after
+    the server made it. A removal error is only reported.
+    """
+    try:
+        task_ids = remove_tasks_by_name(client, task_spec.project_id, task_spec.name)
+        if task_ids:
+            print(f"Removed half-created task {task_spec.name} (IDs: {','.join(str(task_id) for task_id in task_ids)})")
+    except Exception as e:
+        print(f"WARNING: Cannot remove half-created task {task_spec.name}: {type(e).__name__}: {e}")
+
+def create_cvat_task(client, task_spec, patch_paths, data_params, retries, retry_wait_sec, stale_task_ids=()):
+    """
+    Create a task from image patches on the CVAT share and wait until the server has processed its data.
+    The logged-in client is shared by the threads creating tasks (its urllib3 connection pool is thread safe).
+    stale_task_ids (partially created tasks of a previous run) are removed first.
+    Transient errors are retried up to `retries` times, waiting retry_wait_sec, 2 x retry_wait_sec, ... in between.
+    Before every retry, tasks of the same name left by the failed attempt are looked up and removed, so a create()
+    that timed out after the server made the task leaves no duplicate; they are also removed when the task finally fails.
+    """
+    if stale_task_ids:
+        client.tasks.remove_by_ids(list(stale_task_ids))
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            remove_failed_task(client, task_spec)
+        try:
+            task = client.tasks.create(spec=task_spec)
+            task.upload_data(resources=patch_paths, resource_type=ResourceType.SHARE, params=data_params)
+            task.fetch()
+            return task
+        except Exception as e:
+            if attempt == retries or not is_transient_error(e):
+                remove_failed_task(client, task_spec)
+                raise
+            print(f"WARNING: Creating task {task_spec.name} failed ({type(e).__name__}: {e}), retry {attempt + 1}/{retries} in {retry_wait_sec * 2**attempt} sec")
+            time.sleep(retry_wait_sec * 2**attempt)
+
+def get_batch_image_folders(args):
+    """ Image folders of a batch run, from --image_folder_list (one folder per line) or --catalog (slides scanned without error, in name order) """
+    if args.image_folder_list:
+        with open(args.image_folder_list, 'r', encoding="utf-8") as fin:
+            return [line.strip() for line in fin if line.strip() and not line.startswith("#")]
+    catalog = json.load(open(args.catalog, 'r', encoding="utf-8"))
+    return sorted(entry['name'] for entry in catalog.values() if not entry.get('error'))
+
+def prepare_slide(args, cvat_share_path, slide, timestamp):
+    """ Load the image patches of a slide's image folder and group them into tasks by --task_json or --frames_per_task """
+    grouper = ImagePatchGrouper(cvat_share_path, slide['image_folder'], args.image_extension)
+    if args.manifest and not os.path.exists(args.manifest):
+        raise ValueError(f"ERROR: Manifest [{args.manifest}] does not exist.")
+    manifest_file = args.manifest or find_manifest_file(cvat_share_path, slide['image_folder'])
+    if manifest_file:
+        grouper.load_manifest(manifest_file)
+        slide['patch_source'] = 'manifest'
+    else:
+        # Image folders tiled before the manifest existed
+        print(f"WARNING: No *.manifest.tsv in {os.path.join(cvat_share_path, slide['image_folder'])}, patches are taken from the file names")
+        grouper.load_patches()
+        slide['patch_source'] = 'file_names'
+
+    # Load task config, or lay out tasks of about --frames_per_task patches
+    if args.task_json:
+        task_json = args.task_json
+        task_config = json.load(open(args.task_json, 'r', encoding="utf-8"))
+    else:
+        task_json = f"{slide['task_prefix']}.tasks.{timestamp}.json"
+        task_config = get_task_layout(grouper, args.frames_per_task)
+        with open(task_json, 'w', encoding="utf-8") as fout:
+            json.dump(task_config, fout, indent=2)
+        print(f"Task layout ({len(task_config['tasks'])} tasks): {task_json}")
+    grouper.process_tasks(task_config['tasks'])
+    slide.update({'grouper': grouper, 'manifest_file': manifest_file, 'task_json': task_json, 'task_config': task_config})
+
+def plan_slide_tasks(slide, existing_tasks, dryrun):
+    """ Tasks of a previous run: skip complete tasks, recreate partially created ones """
+    slide['task_status'] = {}
+    slide['skipped_tasks'] = {}
+    for task_input in slide['task_config']['tasks']:
+        task_name = f"{slide['task_prefix']}_{task_input['name']}"
+        status, task = get_task_status(existing_tasks.get(task_name, []), len(slide['grouper'].get_task_patches(task_input['name'])))
+        slide['task_status'][task_input['name']] = status
+        if status == 'skipped':
+            slide['skipped_tasks'][task_input['name']] = task
+            if len(existing_tasks[task_name]) > 1:
+                print(f"WARNING: Task {task_name} exists {len(existing_tasks[task_name])} times (IDs: {','.join(str(t.id) for t in existing_tasks[task_name])}), keeping ID {task.id}")
+        print(f"Task {task_name}: {status}{' (dryrun)' if dryrun else ''}")
+
+def collect_slide_tasks(slide):
+    """ Wait for the tasks of a slide, in task config order, into slide['task_infos'] and slide['failed_tasks'] """
+    grouper = slide['grouper']
+    slide['task_infos'] = []
+    slide['failed_tasks'] = []
+    for (task_input, future) in zip(slide['task_config']['tasks'], slide['futures']):
+        status = slide['task_status'][task_input['name']]
+        if future is None:
+            task = slide['skipped_tasks'][task_input['name']]
+        else:
+            try:
+                task = future.result()
+            except Exception as e:
+                print(f"ERROR: Task {slide['task_prefix']}_{task_input['name']} was not created: {type(e).__name__}: {e}")
+                slide['failed_tasks'].append(task_input['name'])
+                continue
+        frame_count = task.size
+        row_start, row_end = grouper.task_regions[task_input['name']]['row']
+        col_start, col_end = grouper.task_regions[task_input['name']]['col']
+        slide['task_infos'].append((task.id, task.name, row_start, row_end, col_start, col_end, frame_count, task.jobs.count, status))
+        print(f"CVAT Task was {status}. ID: {task.id}. Name: {task.name}. Jobs: {task.jobs.count}. Frames: {frame_count}. Row:{row_start}-{row_end}. Cols:{col_start}-{col_end}.")
+
+def write_slide_log(args, cvat_share_path, slide, project, org_slug, timestamp):
+    grouper = slide['grouper']
+    log_entries = {}
+    log_entries['Timestamp'] = timestamp
+    log_entries['CVAT_share_path'] = cvat_share_path
+    log_entries['image_folder'] = slide['image_folder']
+    log_entries['image_extension'] = args.image_extension
+    log_entries['image_folder_path'] = os.path.join(cvat_share_path, slide['image_folder'])
+    log_entries['patch_source'] = slide['patch_source']
+    log_entries['manifest'] = slide['manifest_file'] or '.'
+    log_entries['task_json'] = slide['task_json']
+    log_entries['image_folder_rows'] = grouper.grid_rows
+    log_entries['image_folder_cols'] = grouper.grid_cols
+    log_entries['task_prefix'] = slide['task_prefix']
+    log_entries['project_id'] = args.project_id
+    log_entries['project_name'] = project.name
+    log_entries['project_organization_id'] = project.organization_id
+    log_entries['project_organization_slug'] = org_slug
+    log_entries['concurrency'] = args.concurrency
+    log_entries['cvat_manifest'] = os.path.join(cvat_share_path, slide['image_folder'], CVAT_MANIFEST_FOLDER) if args.cvat_manifest else '.'
+    for status in ('created', 'skipped', 'recreated'):
+        log_entries[f"{status}_task_count"] = sum(1 for task_info in slide['task_infos'] if task_info[-1] == status)
+    log_entries['failed_tasks'] = ",".join(slide['failed_tasks']) or '.'
+    log_entries['total_image_count_in_folder'] = len(grouper.patches)
+    log_entries['total_image_count_in_tasks'] = sum(len(patches) for _, patches in grouper.task_patches.items())
+    for task_name, patches in grouper.task_patches.items():
+        log_entries[f"image_count_{task_name}"] = len(patches)
+
+    log_file = f"{slide['task_prefix']}.create_task.{timestamp}.log"
+    with open(log_file, 'w', encoding="utf-8") as fout:
+        fout.write("Logs: Create CVAT Task\n")
+        fout.write("[Summary]\n")
+        for (k,v) in log_entries.items():
+            fout.write(f"{k}\t{v}\n")
+        fout.write("\n[CVAT_Tasks]\n")
+        fout.write("\t".join(["task_id", "task_name", "row_start", "row_end", "col_start", "col_end", "frame_count", "job_count", "status"]) + "\n")
+        for (task_id, task_name,  row_start, row_end, col_start, col_end, frame_count, job_count, status) in slide['task_infos']:
+            fout.write(f"{task_id}\t{task_name}\t{row_start}\t{row_end}\t{col_start}\t{col_end}\t{frame_count}\t{job_count}\t{status}\n")
+    return log_file
+
+def write_batch_log(args, cvat_share_path, lst_slide, project, timestamp):
+    """ Consolidated log of a batch run: one row per slide and the tasks of all slides """
+    summary_file = f"create_task.batch.{timestamp}.log"
+    num_done = sum(slide['status'] == 'done' for slide in lst_slide)
+    with open(summary_file, 'w', encoding="utf-8") as fout:
+        fout.write("Logs: Create CVAT Task (batch)\n")
+        fout.write("[Summary]\n")
+        fout.write(f"Timestamp\t{timestamp}\n")
+        fout.write(f"CVAT_share_path\t{cvat_share_path}\n")
+        fout.write(f"input\t{args.image_folder_list or args.catalog}\n")
+        fout.write(f"task_json\t{args.task_json or '.'}\n")
+        fout.write(f"frames_per_task\t{args.frames_per_task or '.'}\n")
+        fout.write(f"project_id\t{args.project_id}\n")
+        fout.write(f"project_name\t{project.name}\n")
+        fout.write(f"concurrency\t{args.concurrency}\n")
+        fout.write(f"num_slides\t{len(lst_slide)}\n")
+        fout.write(f"num_done\t{num_done}\n")
+        fout.write(f"num_failed\t{len(lst_slide) - num_done}\n")
+        for status in ('created', 'skipped', 'recreated'):
+            fout.write(f"{status}_task_count\t{sum(1 for slide in lst_slide for task_info in slide.get('task_infos', []) if task_info[-1] == status)}\n")
+        fout.write("\n[Slides]\n")
+        fout.write("\t".join(['image_folder', 'task_prefix', 'status', 'patch_source', 'image_count', 'task_count', 'failed_tasks', 'log_file', 'error']) + '\n')
+        for slide in lst_slide:
+            image_count = len(slide['grouper'].patches) if 'grouper' in slide else ''
+            task_count = len(slide['task_config']['tasks']) if 'task_config' in slide else ''
+            fout.write(f"{slide['image_folder']}\t{slide['task_prefix']}\t{slide['status']}\t{slide.get('patch_source', '')}\t{image_count}\t{task_count}\t{','.join(slide.get('failed_tasks', [])) or '.'}\t{slide.get('log_file', '')}\t{slide['error']}\n")
+        fout.write("\n[CVAT_Tasks]\n")
+        fout.write("\t".join(["image_folder", "task_id", "task_name", "row_start", "row_end", "col_start", "col_end", "frame_count", "job_count", "status"]) + "\n")
+        for slide in lst_slide:
+            for task_info in slide.get('task_infos', []):
+                fout.write("\t".join(str(v) for v in (slide['image_folder'],) + task_info) + "\n")
+    print(f"Batch: {num_done} of {len(lst_slide)} slides done, summary in {summary_file}")
+    return num_done
+
 def main(args):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
@@ -159,16 +527,26 @@ def main(args):
     CVAT_PASSWORD = config['cvat_password']
     CVAT_SHARE_PATH = config['cvat_share_path']
 
-    # Load task config
-    task_config = json.load(open(args.task_json, 'r', encoding="utf-8"))
-
     #-----------------------------------------------
     # Group image patches accordint to task config
     #-----------------------------------------------
     print("ASSIGNING IMAGE TO TASKS:")
-    grouper = ImagePatchGrouper(CVAT_SHARE_PATH, args.image_folder, args.image_extension)
-    grouper.load_patches()
-    grouper.process_tasks(task_config['tasks'])
+    if args.image_folder:
+        lst_slide = [{'image_folder': args.image_folder, 'task_prefix': args.task_prefix, 'status': 'todo', 'error': ''}]
+        prepare_slide(args, CVAT_SHARE_PATH, lst_slide[0], timestamp)
+    else:
+        # Batch: task prefix = image folder name (the tiler's --op); a slide that cannot be grouped does not stop the others
+        lst_slide = [{'image_folder': image_folder, 'task_prefix': os.path.basename(os.path.normpath(image_folder)), 'status': 'todo', 'error': ''}
+                     for image_folder in get_batch_image_folders(args)]
+        for slide in lst_slide:
+            print(f"Image folder: {slide['image_folder']}")
+            try:
+                prepare_slide(args, CVAT_SHARE_PATH, slide, timestamp)
+            except (ValueError, OSError) as e:
+                slide['status'] = 'failed'
+                slide['error'] = f"{type(e).__name__}: {e}"
+                print(f"ERROR: {slide['image_folder']}: {slide['error']}")
+    lst_slide_todo = [slide for slide in lst_slide if slide['status'] == 'todo']
 
     #-----------------------
     # Create CVAT tasks
@@ -185,82 +563,100 @@ def main(args):
             print(f"Using project: {project.name}(ID: {project.id}, organization_slug: {org_slug})")
         except ValueError as e:
             print(f"ERROR in accessing project {args.project_id}: {str(e)}")
-            
-        # Create task
-        task_infos = []
-        for task_input in task_config['tasks']:
-            patch_paths = grouper.get_task_patches(task_input['name'])
-            
-            task_spec = models.TaskWriteRequest(
-                name=f"{args.task_prefix}_{task_input['name']}",
-                project_id=args.project_id,
-                segment_size=args.segment_size
-            )
-            data_params = {
-                'image_quality': 70,
-                'use_zip_chunks': True,
-                'use_cache': True,
-                'sorting_method': 'lexicographical'
-            }
-
-            if not args.dryrun:
-                task = client.tasks.create_from_data(
-                    spec=task_spec,
-                    resource_type=ResourceType.SHARE,
-                    resources=patch_paths,
-                    data_params=data_params
-                )
-                frame_count = len(task.get_frames_info())
-                row_start, row_end = grouper.task_regions[task_input['name']]['row']
-                col_start, col_end = grouper.task_regions[task_input['name']]['col']
-                task_infos.append((task.id, task.name, row_start, row_end, col_start, col_end, frame_count, task.jobs.count))
-                print(f"CVAT Task was created. ID: {task.id}. Name: {task.name}. Jobs: {task.jobs.count}. Frames: {frame_count}. Row:{row_start}-{row_end}. Cols:{col_start}-{col_end}.")
+
+        # Tasks of a previous run, listed once for all slides
+        existing_tasks = get_project_tasks_by_name(project)
+        for slide in lst_slide_todo:
+            plan_slide_tasks(slide, existing_tasks, args.dryrun)
+
+        # Create the tasks of all slides through one queue, up to --concurrency at a time
+        data_params = {
+            'image_quality': 70,
+            'use_zip_chunks': True,
+            'use_cache': True,
+            'sorting_method': 'lexicographical'
+        }
         if not args.dryrun:
-            print("All tasks were created.")
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                for slide in lst_slide_todo:
+                    task_config = slide['task_config']
+                    grouper = slide['grouper']
+                    task_manifests = {}
+                    if args.cvat_manifest:
+                        task_names = [task_input['name'] for task_input in task_config['tasks'] if slide['task_status'][task_input['name']] != 'skipped']
+                        try:
+                            task_manifests = write_cvat_manifests(grouper, task_names, slide['task_prefix'], args.patch_size, args.header_threads)
+                        except OSError as e:
+                            slide['status'] = 'failed'
+                            slide['error'] = f"{type(e).__name__}: {e}"
+                            print(f"ERROR: {slide['image_folder']}: {slide['error']}")
+                            continue
+                    slide['futures'] = []
+                    for task_input in task_config['tasks']:
+                        if slide['task_status'][task_input['name']] == 'skipped':
+                            slide['futures'].append(None)
+                            continue
+                        task_spec = models.TaskWriteRequest(
+                            name=f"{slide['task_prefix']}_{task_input['name']}",
+                            project_id=args.project_id,
+                            segment_size=args.segment_size
+                        )
+                        patch_paths = grouper.get_task_patches(task_input['name'])
+                        if task_input['name'] in task_manifests:
+                            patch_paths = patch_paths + [task_manifests[task_input['name']]]
+                        stale_task_ids = [task.id for task in existing_tasks.get(task_spec.name, [])]
+                        slide['futures'].append(executor.submit(create_cvat_task, client, task_spec, patch_paths, data_params, args.retries, args.retry_wait_sec, stale_task_ids))
+                # Collect in slide and task config order
+                for slide in lst_slide_todo:
+                    if slide['status'] == 'todo':
+                        collect_slide_tasks(slide)
+                        slide['status'] = 'failed' if slide['failed_tasks'] else 'done'
+            if all(slide['status'] == 'done' for slide in lst_slide):
+                print("All tasks were created.")
 
     #-----------------------
     # Write log files
     #-----------------------
     if not args.dryrun:
-        log_entries = {}
-        log_entries['Timestamp'] = timestamp
-        log_entries['CVAT_share_path'] = CVAT_SHARE_PATH
-        log_entries['image_folder'] = args.image_folder
-        log_entries['image_extension'] = args.image_extension
-        log_entries['image_folder_path'] = os.path.join(CVAT_SHARE_PATH, args.image_folder)
-        log_entries['image_folder_rows'] = grouper.grid_rows
-        log_entries['image_folder_cols'] = grouper.grid_cols
-        log_entries['task_prefix'] = args.task_prefix
-        log_entries['project_id'] = args.project_id
-        log_entries['project_name'] = project.name
-        log_entries['project_organization_id'] = org_id
-        log_entries['project_organization_slug'] = org_slug
-        log_entries['total_image_count_in_folder'] = len(grouper.patches)
-        log_entries['total_image_count_in_tasks'] = sum(len(patches) for _, patches in grouper.task_patches.items())
-        for task_name, patches in grouper.task_patches.items():
-            log_entries[f"image_count_{task_name}"] = len(patches)
-            
-        with open(f"{args.task_prefix}.create_task.{timestamp}.log", 'w', encoding="utf-8") as fout:
-            fout.write("Logs: Create CVAT Task\n")
-            fout.write("[Summary]\n")
-            for (k,v) in log_entries.items():
-                fout.write(f"{k}\t{v}\n")
-            fout.write("\n[CVAT_Tasks]\n")
-            fout.write("\t".join(["task_id", "task_name", "row_start", "row_end", "col_start", "col_end", "frame_count", "job_count"]) + "\n")
-            for (task_id, task_name,  row_start, row_end, col_start, col_end, frame_count, job_count) in task_infos:
-                fout.write(f"{task_id}\t{task_name}\t{row_start}\t{row_end}\t{col_start}\t{col_end}\t{frame_count}\t{job_count}\n")
+        for slide in lst_slide_todo:
+            if 'task_infos' not in slide:
+                continue
+            slide['log_file'] = write_slide_log(args, CVAT_SHARE_PATH, slide, project, org_slug, timestamp)
+        if not args.image_folder:
+            num_done = write_batch_log(args, CVAT_SHARE_PATH, lst_slide, project, timestamp)
+            if num_done < len(lst_slide):
+                sys.exit(1)
+        elif lst_slide[0]['status'] != 'done':
+            failed_tasks = lst_slide[0].get('failed_tasks') or [task_input['name'] for task_input in lst_slide[0]['task_config']['tasks']]
+            sys.exit(f"ERROR: {len(failed_tasks)} of {len(lst_slide[0]['task_config']['tasks'])} tasks were not created: {','.join(failed_tasks)}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--image_folder", required=True, help="Folder name under CVAT share path containing image files")
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("--image_folder", help="Folder name under CVAT share path containing image files")
+    input_group.add_argument("--image_folder_list", help="Batch mode: create the tasks of the image folders listed in this file, one per line")
+    input_group.add_argument("--catalog", help="Batch mode: create the tasks of the slides of a catalog written by parse_mrxs.py scan, the image folders being named after the slides")
     parser.add_argument("--image_extension", required=True, choices=["jpg"])
-    parser.add_argument("--task_prefix", required=True)
+    parser.add_argument("--task_prefix", help="Prefix of the task names (required with --image_folder; batch mode uses the image folder name)")
     parser.add_argument("--project_id", type=int, required=True)
     parser.add_argument("--segment_size", type=int, required=True)
     parser.add_argument("--cvat_config", required=True)
-    parser.add_argument("--task_json", required=True, help="json file defining the task")
+    task_layout = parser.add_mutually_exclusive_group(required=True)
+    task_layout.add_argument("--task_json", help="json file defining the task")
+    task_layout.add_argument("--frames_per_task", type=int, help="Lay out tasks of whole rows with about N image patches each (written to <task_prefix>.tasks.<timestamp>.json)")
+    parser.add_argument("--manifest", help="Patch manifest written by mrxs_to_image_patches.py (default: the *.manifest.tsv of <image_folder> if present, else parse the file names)")
+    parser.add_argument("--cvat_manifest", action="store_true", help="Upload a CVAT manifest.jsonl with the images of each task, written to <image_folder>/cvat_manifests")
+    parser.add_argument("--patch_size", type=int, help="With --cvat_manifest: width / height of every image (the tiler's --patch_size, divided by 2^L for level L folders) instead of reading the image headers")
+    parser.add_argument("--header_threads", type=int, default=16, help="With --cvat_manifest: number of threads reading image headers (default: 16)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of tasks created in parallel (default: 1)")
+    parser.add_argument("--retries", type=int, default=3, help="Retries of a task on connection errors, timeouts and HTTP 408/429/5xx (default: 3)")
+    parser.add_argument("--retry_wait_sec", type=float, default=5, help="Wait before the first retry, doubled for every next retry (default: 5)")
     parser.add_argument("--dryrun", action="store_true")
     #arguments = parser.parse_args("--cvat_share_path /NetApp/users/deeplearn/Projects/marrow_morphology/image_3dhistech/ --image_folder 25H0340173/ --image_extension jpg --task_prefix haha --project_id 47 --segment_size 10 --cvat_config /home/olivia/cvat_config.json --task_json tasks.ROI-test.json".split())
     arguments = parser.parse_args()
+    if arguments.image_folder and not arguments.task_prefix:
+        sys.exit("ERROR: --task_prefix is required with --image_folder!")
+    if not arguments.image_folder and (arguments.task_prefix or arguments.manifest):
+        sys.exit("ERROR: --task_prefix and --manifest are not used in batch mode, each image folder is named after its slide and uses its own manifest!")
     main(arguments)
 
@@ -5,8 +5,13 @@
 
 
 import argparse
+import hashlib
 import json
 import pandas as pd
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from cvat_sdk.api_client import Configuration, ApiClient, exceptions
 from cvat_sdk import make_client
@@ -15,14 +20,132 @@ from cvat_sdk import make_client
 # In[ ]:
 
 
+# Shape coordinates in a raw annotations response (e.g. mask RLE), not needed for counting.
+# A string value cannot contain an unescaped quote, so the key pattern only matches "points" keys.
+POINTS_KEY_PATTERN = re.compile(rb'"points"\s*:\s*\[')
+BRACKET_PATTERN = re.compile(rb'[\[\]]')
+
+def strip_points(raw):
+    """
+    Copy of a raw JSON body with every "points" array emptied, matching its brackets by depth so nested arrays are removed whole.
+    The body is not streamed: it stays in memory and is copied once without the points.
+
+    >>> strip_points(b'{"shapes": [{"points": [1.5, 2], "elements": [{"points": [[0, 1], [2, 3]], "label_id": 4}]}], "tags": []}')
+    b'{"shapes": [{"points": [], "elements": [{"points": [], "label_id": 4}]}], "tags": []}'
+    """
+    raw_view = memoryview(raw) # Slices of a memoryview are not copied before the join
+    chunks = []
+    pos = 0
+    while True:
+        match = POINTS_KEY_PATTERN.search(raw, pos)
+        if match is None:
+            break
+        depth = 1
+        for bracket in BRACKET_PATTERN.finditer(raw, match.end()):
+            depth += 1 if bracket.group() == b'[' else -1
+            if depth == 0:
+                break
+        else:
+            raise ValueError(f"Unterminated \"points\" array at byte {match.start()} of the annotations JSON")
+        chunks += [raw_view[pos:match.end()], b']']
+        pos = bracket.end()
+    chunks.append(raw_view[pos:])
+    return b''.join(chunks)
+
+def load_annotations_json(raw):
+    """
+    Parse the raw JSON body of jobs_api.retrieve_annotations into plain dicts / lists.
+    The "points" arrays are emptied on the raw bytes first (strip_points), so their numbers are never turned into Python objects.
+    """
+    return json.loads(strip_points(raw))
+
+def count_annotations(data):
+    """ Count the tags / shapes of job annotations (SDK model or dict from load_annotations_json) by label and by checked attribute """
+    label_counter_job= {} # dict label_id -> count
+    label_any_attr_counter_job = {} # dict label_id -> annotation count of label_id with any attributes checked
+    label_each_attr_counter_job = {} # dict (label_id, attribute_id) -> annnotation count
+    for data_type in ('tags', 'shapes'):
+        for annot in data[data_type]:
+            label_id = annot['label_id']
+            label_counter_job[label_id] = label_counter_job.get(label_id, 0) + 1
+            # Process labels with attributes
+            if annot['attributes']:
+                is_any_attr_checked = False # if any of the attributes is checked
+                for attr in annot['attributes']:
+                    if attr['value'] == "true":
+                        k = (label_id, attr['spec_id'])
+                        label_each_attr_counter_job[k] = label_each_attr_counter_job.get(k, 0) + 1
+                        is_any_attr_checked = True
+                if is_any_attr_checked:
+                    label_any_attr_counter_job[label_id] = label_any_attr_counter_job.get(label_id, 0) + 1
+    return label_counter_job, label_any_attr_counter_job, label_each_attr_counter_job
+
+class JobCounterCache():
+    """
+    SQLite cache of the per-job label / attribute counters, keyed by job id and the job's updated_date.
+    A job is counted again only when it is new or its updated_date changed. All jobs of a project are
+    dropped when the hash of the project's label schema changes (labels or attributes added, removed or renamed).
+    """
+    def __init__(self, cache_db):
+        self.conn = sqlite3.connect(cache_db)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS label_schema (project_id INTEGER PRIMARY KEY, schema_hash TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS job_counter (job_id INTEGER PRIMARY KEY, project_id INTEGER NOT NULL, updated_date TEXT NOT NULL, "
+                          "label_counts TEXT NOT NULL, label_any_attr_counts TEXT NOT NULL, label_each_attr_counts TEXT NOT NULL)")
+        self.conn.commit()
+
+    def check_label_schema(self, project_id, project_labels):
+        """ Drop the cached jobs of the project if its label schema changed since they were counted """
+        schema_hash = hashlib.sha256(json.dumps(sorted(project_labels.items()), sort_keys=True).encode()).hexdigest()
+        row = self.conn.execute("SELECT schema_hash FROM label_schema WHERE project_id = ?", (project_id,)).fetchone()
+        if row is not None and row[0] != schema_hash:
+            print(f"Label schema of project {project_id} changed, cached job counters are dropped")
+            self.conn.execute("DELETE FROM job_counter WHERE project_id = ?", (project_id,))
+        self.conn.execute("INSERT OR REPLACE INTO label_schema (project_id, schema_hash) VALUES (?, ?)", (project_id, schema_hash))
+        self.conn.commit()
+
+    def get(self, job_id, updated_date):
+        """ The three counter dicts of a job, or None if the job is not cached with this updated_date """
+        row = self.conn.execute("SELECT label_counts, label_any_attr_counts, label_each_attr_counts FROM job_counter WHERE job_id = ? AND updated_date = ?",
+                                (job_id, updated_date)).fetchone()
+        if row is None:
+            return None
+        label_counts, label_any_attr_counts, label_each_attr_counts = (json.loads(v) for v in row)
+        return ({label_id: count for (label_id, count) in label_counts},
+                {label_id: count for (label_id, count) in label_any_attr_counts},
+                {(label_id, attr_id): count for (label_id, attr_id, count) in label_each_attr_counts})
+
+    def put(self, project_id, job_id, updated_date, counters):
+        label_counter, label_any_attr_counter, label_each_attr_counter = counters
+        self.conn.execute("INSERT OR REPLACE INTO job_counter VALUES (?, ?, ?, ?, ?, ?)",
+                          (job_id, project_id, updated_date,
+                           json.dumps(list(label_counter.items())),
+                           json.dumps(list(label_any_attr_counter.items())),
+                           json.dumps([(label_id, attr_id, count) for ((label_id, attr_id), count) in label_each_attr_counter.items()])))
+
+    def prune(self, project_id, job_ids):
+        """ Drop cached jobs of the project that are no longer completed jobs """
+        cached_job_ids = [row[0] for row in self.conn.execute("SELECT job_id FROM job_counter WHERE project_id = ?", (project_id,))]
+        self.conn.executemany("DELETE FROM job_counter WHERE job_id = ?", [(job_id,) for job_id in cached_job_ids if job_id not in job_ids])
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
 class Cvat_Stat():
-    def __init__(self, cvat_url, cvat_username, cvat_password, project_id):
-        # API Client
-        self.api_client = ApiClient(
-            Configuration(host = cvat_url, username = cvat_username, password = cvat_password)
-            )
+    def __init__(self, cvat_url, cvat_username, cvat_password, project_id, workers=8, cache_db=None, parse_sdk_models=False):
+        # API Client, shared by the threads retrieving annotations: keep one keep-alive connection per thread in its pool
+        configuration = Configuration(host = cvat_url, username = cvat_username, password = cvat_password)
+        configuration.connection_pool_maxsize = max(configuration.connection_pool_maxsize, workers)
+        self.api_client = ApiClient(configuration)
         
         self.project_id = project_id
+        self.workers = workers # No. of jobs whose annotations are retrieved in parallel
+        self.cache_db = cache_db # SQLite cache of the per-job counters, None for no cache
+        self.parse_sdk_models = parse_sdk_models # Count annotations from SDK models instead of the raw JSON response
+        self.api_calls = {} # dict API endpoint -> No. of calls in this run
+        self.api_calls_lock = threading.Lock()
         self.organization_slug = self._get_organization_slug(self.project_id)
     
         # Python SDK Client
@@ -30,11 +153,16 @@ class Cvat_Stat():
         self.client.organization_slug = self.organization_slug 
 
         self.completed_jobs = {} # dict task_id -> job_id
+        self.task_names = {} # dict task_id -> task name, prefetched for the whole project
+        self.job_details = {} # dict job_id -> {frame_count, updated_date, assignee}, prefetched with the completed jobs
+        self.job_versions = {} # dict job_id -> updated_date (ISO format) of the completed jobs, key of the job counter cache
         self.project_labels = {} # dict label_id -> (label_name, label_type)
         
         self.job_label_counter = {} # dict job_id -> label_id -> count
         self.job_label_any_attr_counter = {} # dict job_id -> label_id -> count with any attribute checked
         self.job_label_each_attr_counter = {} # dict job_id -> (label_id, attribute_id) -> count
+        self.job_errors = {} # dict job_id -> error of annotation retrieval
+        self.cached_job_ids = set() # Jobs whose counters were taken from the cache
 
         self.merged_label_counter = {} # dict label_id -> count
         self.merged_label_any_attr_counter = {} # dict label_id -> count with any attribute checked
@@ -46,25 +174,66 @@ class Cvat_Stat():
     def stat_labels(self):
         self.project_labels = self._get_project_label(self.project_id)
         self.completed_jobs = self._get_completed_jobs(self.project_id)
+        self.task_names = self._get_task_names(self.project_id)
 
         # Reset 
         self.job_label_counter = {} # dict job_id -> label_id -> count
         self.job_label_any_attr_counter = {} # dict job_id -> label_id -> count with any attribute checked
         self.job_label_each_attr_counter = {} # dict job_id -> (label_id, attribute_id) -> count
+        self.job_errors = {} # dict job_id -> error of annotation retrieval
         self.merged_label_counter = {} # dict label_id -> count
         self.merged_label_any_attr_counter = {} # dict label_id -> count with any attribute checked
         self.merged_label_each_attr_counter = {} # dict (label_id, attribute_id) -> count
 
-        for (task_id, job_ids) in self.completed_jobs.items():
-            #task_name = self._get_task_name(task_id)
-            for job_id in job_ids:
-                self.job_label_counter[job_id], self.job_label_any_attr_counter[job_id], self.job_label_each_attr_counter[job_id] = self._retrieve_annotation(job_id)
-                for (label_id, count) in self.job_label_counter[job_id].items():
-                    self.merged_label_counter[label_id] = self.merged_label_counter.get(label_id, 0) + count
-                for (label_id, count) in self.job_label_any_attr_counter[job_id].items():
-                    self.merged_label_any_attr_counter[label_id] = self.merged_label_any_attr_counter.get(label_id, 0) + count
-                for ((label_id, attr_id), count) in self.job_label_each_attr_counter[job_id].items():
-                    self.merged_label_each_attr_counter[(label_id, attr_id)] = self.merged_label_each_attr_counter.get((label_id, attr_id), 0) + count
+        self.cached_job_ids = set()
+
+        # Counters of jobs unchanged since the last run
+        cache = None
+        cached_counters = {}
+        if self.cache_db:
+            cache = JobCounterCache(self.cache_db)
+            cache.check_label_schema(self.project_id, self.project_labels)
+            for job_ids in self.completed_jobs.values():
+                for job_id in job_ids:
+                    counters = cache.get(job_id, self.job_versions[job_id])
+                    if counters is not None:
+                        cached_counters[job_id] = counters
+            self.cached_job_ids = set(cached_counters)
+
+        # Retrieve and count annotations of the other jobs, up to self.workers jobs at a time
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {job_id: executor.submit(self._retrieve_annotation, job_id) for job_ids in self.completed_jobs.values() for job_id in job_ids if job_id not in cached_counters}
+
+            # Merge in task / job order, so the merged dicts do not depend on which job finishes first
+            for (task_id, job_ids) in self.completed_jobs.items():
+                #task_name = self._get_task_name(task_id)
+                for job_id in job_ids:
+                    if job_id in cached_counters:
+                        counters = cached_counters[job_id]
+                    else:
+                        try:
+                            counters = futures[job_id].result()
+                        except Exception as e:
+                            self.job_errors[job_id] = f"{type(e).__name__}: {e}"
+                            print(f"Exception when calling JobsApi.retrieve_annotations() for job {job_id}: {self.job_errors[job_id]}\n")
+                            continue
+                        if cache is not None:
+                            cache.put(self.project_id, job_id, self.job_versions[job_id], counters)
+                    self.job_label_counter[job_id], self.job_label_any_attr_counter[job_id], self.job_label_each_attr_counter[job_id] = counters
+                    for (label_id, count) in self.job_label_counter[job_id].items():
+                        self.merged_label_counter[label_id] = self.merged_label_counter.get(label_id, 0) + count
+                    for (label_id, count) in self.job_label_any_attr_counter[job_id].items():
+                        self.merged_label_any_attr_counter[label_id] = self.merged_label_any_attr_counter.get(label_id, 0) + count
+                    for ((label_id, attr_id), count) in self.job_label_each_attr_counter[job_id].items():
+                        self.merged_label_each_attr_counter[(label_id, attr_id)] = self.merged_label_each_attr_counter.get((label_id, attr_id), 0) + count
+                if cache is not None:
+                    cache.commit() # Once per task, so an interrupted run keeps the jobs already counted
+
+        if cache is not None:
+            cache.prune(self.project_id, set(self.job_versions))
+            cache.commit()
+            cache.close()
+        print(f"Annotations of {len(self.cached_job_ids)} jobs from cache, {len(futures)} jobs retrieved")
 
     def get_summary_table(self):
         summary_rows = []
@@ -74,9 +243,11 @@ class Cvat_Stat():
         tag_label_names = [v['name'] for (k, v) in self.project_labels.items() if v['type']=='tag']
         
         for (task_id, job_ids) in self.completed_jobs.items():
-            task_name = self._get_task_name(task_id)
+            task_name = self.task_names[task_id] if task_id in self.task_names else self._get_task_name(task_id)
             for job_id in job_ids:
-                job_detail = self._get_job_detail(job_id)
+                if job_id in self.job_errors: # Annotations could not be retrieved
+                    continue
+                job_detail = self.job_details[job_id] if job_id in self.job_details else self._get_job_detail(job_id)
                 label_counts = self.job_label_counter[job_id]
                 label_any_attr_counts = self.job_label_any_attr_counter[job_id]
                 label_each_attr_counts = self.job_label_each_attr_counter[job_id]
@@ -119,13 +290,23 @@ class Cvat_Stat():
         df_summary = pd.concat([df_summary_job, pd.DataFrame([summary_row])], ignore_index=True)
         return df_summary
 
+    # API calls
+    def _call_api(self, endpoint_name, endpoint, *args, **kwargs):
+        """ Call an API endpoint and count the call in self.api_calls (thread safe) """
+        with self.api_calls_lock:
+            self.api_calls[endpoint_name] = self.api_calls.get(endpoint_name, 0) + 1
+        return endpoint(*args, **kwargs)
+
+    def get_api_call_count(self):
+        return sum(self.api_calls.values())
+
     # Projects
     def _get_project_label(self, project_id):
         try:
             project_labels = {} # dict label_id -> {name: label_name, type: label_type, attributes: dict attribute_id -> attribute name}
             page = 1
             while True:
-                (data, response) = self.api_client.labels_api.list(project_id=project_id, page=page, page_size=100)
+                (data, response) = self._call_api('LabelsApi.list', self.api_client.labels_api.list, project_id=project_id, page=page, page_size=100)
                 for label in data['results']:
                     project_labels[label.id] = {
                         'name':label.name, 
@@ -145,9 +326,9 @@ class Cvat_Stat():
 
     def _get_organization_slug(self, project_id):
         try:
-            (data_proj, response_proj) = self.api_client.projects_api.retrieve(project_id)
+            (data_proj, response_proj) = self._call_api('ProjectsApi.retrieve', self.api_client.projects_api.retrieve, project_id)
             try: 
-                (data_org, response_org) = self.api_client.organizations_api.retrieve(data_proj.organization_id)
+                (data_org, response_org) = self._call_api('OrganizationsApi.retrieve', self.api_client.organizations_api.retrieve, data_proj.organization_id)
                 return data_org['name']
             except exceptions.ApiException as e:
                 print("Exception when calling OrganizationsApi.list(): %s\n" % e)
@@ -161,7 +342,7 @@ class Cvat_Stat():
             completed_job_count = 0
             page = 1
             while True:
-                (data, response) = self.api_client.jobs_api.list(
+                (data, response) = self._call_api('JobsApi.list', self.api_client.jobs_api.list,
                     org=self.organization_slug, 
                     project_id=project_id, 
                     state="completed", 
@@ -169,6 +350,8 @@ class Cvat_Stat():
                 for job in data['results']:
                     task_id = job['task_id']
                     completed_jobs.setdefault(task_id, []).append(job.id)
+                    self.job_details[job.id] = self._parse_job_detail(job)
+                    self.job_versions[job.id] = job['updated_date'].isoformat() if job['updated_date'] else ''
                     completed_job_count += 1
                 if not data['next']:
                     assert data['count'] == completed_job_count
@@ -178,50 +361,65 @@ class Cvat_Stat():
         except exceptions.ApiException as e:
             print("Exception when calling JobsApi.list(): %s\n" % e)
 
+    def _parse_job_detail(self, data):
+        """ Frame count, updated date and assignee of a job, from jobs_api.list results or jobs_api.retrieve """
+        job_detail = {'frame_count': data['frame_count']}
+        if data['updated_date']:
+            job_detail['updated_date'] = data['updated_date'].strftime("%Y%m%d_%H%M%S")
+        if data['assignee']:
+            job_detail['assignee'] = data['assignee']['username']
+        return job_detail
+
     def _get_job_detail(self, job_id):
-        job_detail = {}
+        """ Job detail of a job missing from self.job_details """
         try:
-            (data, response) = self.api_client.jobs_api.retrieve(job_id)
-            job_detail = {'frame_count': data['frame_count']}
-            if data['updated_date']:
-                job_detail['updated_date'] = data['updated_date'].strftime("%Y%m%d_%H%M%S")
-            if data['assignee']:
-                job_detail['assignee'] = data['assignee']['username']
-            return job_detail
+            (data, response) = self._call_api('JobsApi.retrieve', self.api_client.jobs_api.retrieve, job_id)
+            self.job_details[job_id] = self._parse_job_detail(data)
+            return self.job_details[job_id]
         except exceptions.ApiException as e:
             print("Exception when calling JobsApi.retrieve(): %s\n" % e)
  
     def _retrieve_annotation(self, job_id):
-        label_counter_job= {} # dict label_id -> count
-        label_any_attr_counter_job = {} # dict label_id -> annotation count of label_id with any attributes checked
-        label_each_attr_counter_job = {} # dict (label_id, attribute_id) -> annnotation count
-        try:
-            (data, response) = self.api_client.jobs_api.retrieve_annotations(job_id)
-            for data_type in ('tags', 'shapes'):
-                for annot in data[data_type]:
-                    label_id = annot['label_id']
-                    label_counter_job[label_id] = label_counter_job.get(label_id, 0) + 1
-                    # Process labels with attributes
-                    if annot['attributes']:
-                        is_any_attr_checked = False # if any of the attributes is checked
-                        for attr in annot['attributes']:
-                            if attr['value'] == "true":
-                                k = (label_id, attr['spec_id'])
-                                label_each_attr_counter_job[k] = label_each_attr_counter_job.get(k, 0) + 1
-                                is_any_attr_checked = True
-                        if is_any_attr_checked:
-                            label_any_attr_counter_job[label_id] = label_any_attr_counter_job.get(label_id, 0) + 1
-            return label_counter_job, label_any_attr_counter_job, label_each_attr_counter_job
-        except exceptions.ApiException as e:
-            print("Exception when calling JobsApi.retrieve_annotations(): %s\n" % e)
+        """
+        Count the tags / shapes of a job by label and by checked attribute. Runs in the worker threads; API errors are raised to stat_labels().
+        By default the raw response is parsed without its "points" instead of being deserialized into SDK models.
+        """
+        if self.parse_sdk_models:
+            (data, response) = self._call_api('JobsApi.retrieve_annotations', self.api_client.jobs_api.retrieve_annotations, job_id)
+        else:
+            (_, response) = self._call_api('JobsApi.retrieve_annotations', self.api_client.jobs_api.retrieve_annotations, job_id, _parse_response=False)
+            data = load_annotations_json(response.data)
+        return count_annotations(data)
         
     # Tasks
+    def _get_task_names(self, project_id):
+        """ Names of all tasks of the project, listed page by page """
+        try:
+            task_names = {} # dict task_id -> task name
+            page = 1
+            while True:
+                (data, response) = self._call_api('TasksApi.list', self.api_client.tasks_api.list,
+                    org=self.organization_slug,
+                    project_id=project_id,
+                    page=page, page_size=100)
+                for task in data['results']:
+                    task_names[task.id] = task['name']
+                if not data['next']:
+                    break
+                page += 1
+            return task_names
+        except exceptions.ApiException as e:
+            print("Exception when calling TasksApi.list(): %s\n" % e)
+            return task_names
+
     def _get_task_name(self, task_id):
+        """ Name of a task missing from self.task_names """
         try:
             # tasks_api.retrieve: Retrieve task detail 
-            (data, response) = self.api_client.tasks_api.retrieve(task_id)
+            (data, response) = self._call_api('TasksApi.retrieve', self.api_client.tasks_api.retrieve, task_id)
         except exceptions.ApiException as e:
             print("Exception when calling TasksApi.retrieve(): %s\n" % e)
+        self.task_names[task_id] = data['name']
         return data['name']
 
 def main(args):
@@ -231,8 +429,11 @@ def main(args):
     CVAT_USERNAME = config['cvat_username']
     CVAT_PASSWORD = config['cvat_password']
 
-    cvat_stat = Cvat_Stat(CVAT_URL, CVAT_USERNAME, CVAT_PASSWORD, args.project_id)
+    cvat_stat = Cvat_Stat(CVAT_URL, CVAT_USERNAME, CVAT_PASSWORD, args.project_id, workers=args.workers, cache_db=args.cache_db, parse_sdk_models=args.parse_sdk_models)
+    if cvat_stat.job_errors:
+        print(f"WARNING: Annotations of {len(cvat_stat.job_errors)} jobs could not be retrieved and are not in the summary: {','.join(str(job_id) for job_id in cvat_stat.job_errors)}")
     df_summary = cvat_stat.get_summary_table()
+    print(f"API calls: {cvat_stat.get_api_call_count()} ({', '.join(f'{k}: {v}' for (k, v) in sorted(cvat_stat.api_calls.items()))})")
     if args.do_not_output_attributes:
         cols_xattr = [x for x in df_summary.columns if ("(attr)" not in x) and ("[" not in x)]
         df_summary = df_summary[cols_xattr]
@@ -244,6 +445,9 @@ if __name__ == "__main__":
     parser.add_argument('--project_id', type=int, required=True)
     parser.add_argument('--output_file', required=True)
     parser.add_argument('--do_not_output_attributes', action='store_true')
+    parser.add_argument('--cache_db', help="SQLite file caching the label counts of every job by job id and updated date; only new or modified jobs are retrieved again")
+    parser.add_argument('--parse_sdk_models', action='store_true', help="Count annotations from the SDK's deserialized models instead of the raw JSON response (slower, same counts)")
+    parser.add_argument('--workers', type=int, default=8, help="No. of jobs whose annotations are retrieved in parallel (default: 8)")
     #arguments = parser.parse_args("--cvat_config /home/olivia/cvat_config.json --project_id 1 --output_file haha.txt".split())
     arguments = parser.parse_args()
     main(arguments)
@@ -0,0 +1,13 @@
+#!/bin/bash
+set -euo pipefail
+
+bin=$(dirname $0)
+project_id=1
+outdir=/NetApp/users/deeplearn/Projects/marrow_morphology/cvat_annotation_stat
+
+# Label counts of the completed jobs; counts of jobs unchanged since the last run are read from the cache
+/NetApp/users/olivia/anaconda3/envs/cvat_2.47.0/bin/python ${bin}/../04_annotation_stat/cvat_summarize_annotation_labels.py \
+    --cvat_config /home/olivia/cvat_config.json \
+    --project_id ${project_id} \
+    --cache_db ${outdir}/annotation_label_stat.project${project_id}.cache.sqlite \
+    --output_file ${outdir}/annotation_label_stat.$(date +"%Y%m%d_%H%M").txt